@@ -1,38 +1,636 @@
-from flask import Flask, render_template_string, jsonify, request, send_from_directory, send_file
+from flask import Flask, Response, render_template_string, jsonify, request, send_from_directory, send_file, g
+from flask.json.provider import DefaultJSONProvider
+from collections import deque, OrderedDict, Counter
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
+import numpy as np
+import openpyxl
+import codecs
 import io
 import datetime
 import random
 import os
 import time
+import json
+import math
+import sqlite3
+import threading
+import bisect
+import heapq
+import gzip
+import queue
+import uuid
+import hashlib
+import tempfile
+import shutil
+import multiprocessing
+import sys
+import hmac
 
 # --- SETUP ---
+# Offline mode answers reverse-geocoding from a local gazetteer only (no network calls)
+GAZETTEER_PATH = os.environ.get('SKYSENSE_GAZETTEER')
+GEOCODER_MODE = os.environ.get('SKYSENSE_GEOCODER', 'offline' if GAZETTEER_PATH else 'online')
 try:
     from geopy.geocoders import Nominatim
     # Random User Agent to avoid blocking
-    geolocator = Nominatim(user_agent=f"skysense_final_gold_{random.randint(10000,99999)}")
+    geolocator = Nominatim(user_agent=f"skysense_final_gold_{random.randint(10000,99999)}") if GEOCODER_MODE != 'offline' else None
 except ImportError:
     geolocator = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None  # listed in requirements.txt; without it only /export/parquet is unavailable (501)
 
 app = Flask(__name__)
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+LIVE_CHART_POINTS = 50
+TREND_POINTS = 60  # max points per /api/trends window
+TREND_MAX_DAYS = 3660  # ~10 years; larger windows overflow date arithmetic
+
+# --- LIVE CHART BUFFER ---
+class ChartBuffer:
+    """Fixed-capacity ring of chart points; appending evicts the oldest point in O(1)"""
+    def __init__(self, aqi=(), gps=()):
+        self.reset(aqi, gps)
+
+    def reset(self, aqi, gps):
+        # An uploaded flight may be longer than the live window; keep all of it until live points push it out
+        pts = list(zip(aqi, gps))
+        self.points = deque(pts, maxlen=max(LIVE_CHART_POINTS, len(pts)))
+
+    def append(self, aqi, lat, lon): self.points.append((aqi, {"lat": lat, "lon": lon}))
+    def last_gps(self): return self.points[-1][1] if self.points else None
+    def __len__(self): return len(self.points)
+    def to_dict(self): return {"aqi": [p[0] for p in self.points], "gps": [p[1] for p in self.points]}
+
+class SkySenseJSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        if isinstance(o, ChartBuffer): return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+app.json = SkySenseJSONProvider(app)
 
 # --- GLOBAL DATA ---
-history_log = [] 
-historical_stats = [] 
-location_cache = {} 
+class LRUCache:
+    """Bounded mapping that evicts the least recently used key"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data: return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize: self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock: return self.data.pop(key, default)
+
+    def __len__(self): return len(self.data)
+
+location_cache = LRUCache(int(os.environ.get('SKYSENSE_LOCATION_CACHE', 4096)))
 
 current_data = {
     "aqi": 0, "pm1": 0, "pm25": 0, "pm10": 0, "temp": 0, "hum": 0,
     "avg_aqi": 0, "avg_pm1": 0, "avg_pm25": 0, "avg_pm10": 0, "avg_temp": 0, "avg_hum": 0,
     "status": "Waiting...", "location_name": "Waiting for GPS...",
-    "lat": 0, "lon": 0,
-    "health_risks": [], "chart_data": {"aqi":[], "gps":[]},
+    "lat": 0, "lon": 0, "device": None,  # the sensor the values describe (None: untagged readings or a flight)
+    "health_risks": [], "chart_data": ChartBuffer(), "rolling": {},
     "esp32_log": ["> System Initialized..."], "last_updated": "Never"
 }
 
+# --- METRICS ---
+# Counters and latency histograms live in each process and are flushed to the store every METRICS_FLUSH_S,
+# so /metrics on any gunicorn worker reports the sum over all of them (Prometheus text format).
+METRICS_FLUSH_S = float(os.environ.get('SKYSENSE_METRICS_FLUSH', 5))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_HELP = {
+    "skysense_http_request_duration_seconds": ("histogram", "Request latency by route (streamed bodies: time to first byte)"),
+    "skysense_http_responses_total": ("counter", "Responses by route and status"),
+    "skysense_section_duration_seconds": ("histogram", "Time in instrumented hot paths (parse, locate, geocode, health, encode)"),
+    "skysense_rows_ingested_total": ("counter", "Flight rows parsed from uploads"),
+    "skysense_readings_total": ("counter", "Live sensor readings accepted"),
+    "skysense_readings_per_second": ("gauge", "Live sensor readings per second over the last minute"),
+    "skysense_geocode_cache_hits_total": ("counter", "Place lookups answered from the cache or gazetteer"),
+    "skysense_geocode_cache_misses_total": ("counter", "Place lookups with no cached name (queued for the online geocoder, or plain coordinates)"),
+    "skysense_upload_bytes_total": ("counter", "Bytes received by /upload"),
+}
+
+class Metrics:
+    """Thread-safe counters and fixed-bucket histograms keyed by (name, sorted label pairs)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters, self.hists = {}, {}
+        self.readings = deque()  # (second, count) for the readings-per-second gauge
+        self.flushed = 0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None: h = self.hists[key] = [0] * (len(LATENCY_BUCKETS) + 3)  # buckets, +Inf, sum, count
+            h[i] += 1; h[-2] += seconds; h[-1] += 1
+
+    def count_readings(self, n):
+        self.inc("skysense_readings_total", n)
+        now = int(time.time())
+        with self.lock:
+            if self.readings and self.readings[-1][0] == now: self.readings[-1][1] += n
+            else: self.readings.append([now, n])
+            while self.readings[0][0] <= now - 60: self.readings.popleft()
+
+    def snapshot(self):
+        with self.lock:
+            now = int(time.time())
+            rate = sum(n for t, n in self.readings if t > now - 60) / 60
+            return {"counters": [[k, list(map(list, l)), v] for (k, l), v in self.counters.items()],
+                    "hists": [[k, list(map(list, l)), list(h)] for (k, l), h in self.hists.items()],
+                    "gauges": [["skysense_readings_per_second", [], rate]]}
+
+    def flush(self, force=False):
+        now = time.time()
+        if force or now - self.flushed >= METRICS_FLUSH_S:
+            self.flushed = now
+            store.put_metrics(os.getpid(), json.dumps(self.snapshot()))
+
+metrics = Metrics()
+
+def _labels(pairs):
+    if not pairs: return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in pairs) + '}'
+
+def _value(v):
+    # Exact: %g would print a byte counter of 12345678 as 1.23457e+07
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+def render_metrics(snapshots):
+    """Prometheus text exposition of the summed snapshots"""
+    counters, hists = {}, {}
+    for snap in snapshots:
+        for name, labels, v in snap['counters'] + snap['gauges']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + v
+        for name, labels, h in snap['hists']:
+            key = (name, tuple(map(tuple, labels)))
+            acc = hists.setdefault(key, [0] * len(h))
+            for i, v in enumerate(h): acc[i] += v
+    out = []
+    for name, (kind, doc) in METRIC_HELP.items():
+        out += [f"# HELP {name} {doc}", f"# TYPE {name} {kind}"]
+        for (n, labels), v in sorted(counters.items()):
+            if n == name: out.append(f"{name}{_labels(labels)} {_value(v)}")
+        for (n, labels), h in sorted(hists.items()):
+            if n != name: continue
+            cum = 0
+            for le, c in zip([*map(str, LATENCY_BUCKETS), "+Inf"], h):
+                cum += c
+                out.append(f"{name}_bucket{_labels((*labels, ('le', le)))} {cum}")
+            out += [f"{name}_sum{_labels(labels)} {h[-2]:.6f}", f"{name}_count{_labels(labels)} {h[-1]}"]
+    return '\n'.join(out) + '\n'
+
+@contextmanager
+def timed(section):
+    """Records the block's (or, as a decorator, the call's) duration under skysense_section_duration_seconds"""
+    t = time.perf_counter()
+    try: yield
+    finally: metrics.observe("skysense_section_duration_seconds", time.perf_counter() - t, section=section)
+
+# --- SAMPLING PROFILER ---
+# Off unless SKYSENSE_PROFILE_TOKEN is set. With the token, ?profile=<token> (or an X-Profile header) returns one
+# request's profile instead of its body (unless no sample landed; see X-Profile-Samples), and /debug/profile
+# samples this worker for a time window.
+# Output is collapsed stacks ("root;...;leaf count"), ready for flamegraph.pl or speedscope.
+PROFILE_TOKEN = os.environ.get('SKYSENSE_PROFILE_TOKEN')
+PROFILE_INTERVAL = float(os.environ.get('SKYSENSE_PROFILE_INTERVAL', 0.005))
+PROFILE_MAX_SECONDS = 300
+
+class Sampler:
+    """Samples Python stacks from a background thread via sys._current_frames (all threads, or thread_ids)"""
+    def __init__(self, thread_ids=None, interval=PROFILE_INTERVAL):
+        self.thread_ids, self.interval = thread_ids, interval
+        self.stacks, self.samples = Counter(), 0
+        self.started, self.deadline = time.time(), None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, seconds=None):
+        if seconds: self.deadline = time.time() + seconds
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return self
+
+    @property
+    def running(self): return self.thread.is_alive()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.done.wait(self.interval):
+            if self.deadline and time.time() > self.deadline: break
+            for tid, frame in sys._current_frames().items():
+                if tid == own or (self.thread_ids and tid not in self.thread_ids): continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+profile_window = None  # this worker's /debug/profile sampler
+
+def profile_authorized(token): return bool(PROFILE_TOKEN and token and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode()))
+
+# --- PERSISTENT STORE ---
+DB_PATH = os.environ.get('SKYSENSE_DB', os.path.join(os.getcwd(), 'skysense.db'))
+HISTORY_LIMIT = int(os.environ.get('SKYSENSE_HISTORY', 100))  # upload log rows sent to the dashboard
+JOB_STALE_S = float(os.environ.get('SKYSENSE_JOB_STALE', 900))  # queued/running jobs silent this long are reported failed
+
+def _num(v):
+    try: v = float(v)
+    except (TypeError, ValueError): return None
+    return v if math.isfinite(v) else None
+
+class SqliteConnections:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def conn(self):
+        # One connection per thread, reopened after a fork (sqlite handles must not cross processes)
+        c = getattr(self.local, 'conn', None)
+        if c is None or self.local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=30)
+            c.row_factory = sqlite3.Row
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn, self.local.pid = c, os.getpid()
+        return c
+
+class Store(SqliteConnections):
+    """SQLite (WAL) file store for upload records, rollups and raw readings"""
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS uploads (id INTEGER PRIMARY KEY, date TEXT NOT NULL, filename TEXT, status TEXT, aqi INTEGER, sha256 TEXT);
+    CREATE INDEX IF NOT EXISTS uploads_date ON uploads(date);
+    CREATE INDEX IF NOT EXISTS uploads_sha256 ON uploads(sha256);
+    CREATE TABLE IF NOT EXISTS daily_aqi (date TEXT PRIMARY KEY, aqi INTEGER, pm25 REAL, pm10 REAL);
+    CREATE TABLE IF NOT EXISTS readings (id INTEGER PRIMARY KEY, ts REAL NOT NULL, device TEXT, pm1 REAL, pm25 REAL, pm10 REAL, temp REAL, hum REAL, lat REAL, lon REAL, aqi INTEGER);
+    CREATE INDEX IF NOT EXISTS readings_ts ON readings(ts);
+    CREATE INDEX IF NOT EXISTS readings_device ON readings(device, ts);
+    CREATE TABLE IF NOT EXISTS rollups (period TEXT NOT NULL, bucket TEXT NOT NULL, n INTEGER NOT NULL,
+        aqi_n INTEGER, aqi_sum REAL, aqi_min REAL, aqi_max REAL, pm25_n INTEGER, pm25_sum REAL, pm25_min REAL, pm25_max REAL,
+        pm10_n INTEGER, pm10_sum REAL, pm10_min REAL, pm10_max REAL, PRIMARY KEY (period, bucket));
+    CREATE TABLE IF NOT EXISTS geocache (key TEXT PRIMARY KEY, name TEXT, claimed REAL);
+    CREATE TABLE IF NOT EXISTS geo_rate (id INTEGER PRIMARY KEY CHECK (id = 1), next_at REAL NOT NULL);
+    CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, filename TEXT, date TEXT, rows INTEGER DEFAULT 0,
+        created REAL, updated REAL, result TEXT, error TEXT, sha256 TEXT);
+    CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER, updated REAL);
+    CREATE TABLE IF NOT EXISTS metrics (pid INTEGER PRIMARY KEY, updated REAL NOT NULL, data TEXT NOT NULL);
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.conn().executescript(self.SCHEMA)
+
+    def add_upload(self, date, filename, aqi, pm25=None, pm10=None, sha256=None, status="Success"):
+        # The day's flight value: a later upload for the same date replaces it (see rollups())
+        with self.conn() as c:
+            c.execute("INSERT INTO uploads (date, filename, status, aqi, sha256) VALUES (?,?,?,?,?)", (date, filename, status, aqi, sha256))
+            c.execute("INSERT INTO daily_aqi (date, aqi, pm25, pm10) VALUES (?,?,?,?) ON CONFLICT(date) DO UPDATE SET "
+                      "aqi=excluded.aqi, pm25=excluded.pm25, pm10=excluded.pm10", (date, aqi, pm25, pm10))
+
+    def add_readings(self, rows):
+        """rows: (ts, device, pm1, pm25, pm10, temp, hum, lat, lon, aqi) tuples"""
+        with self.conn() as c:
+            c.executemany("INSERT INTO readings (ts, device, pm1, pm25, pm10, temp, hum, lat, lon, aqi) VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+            self._roll(c, [(datetime.date.fromtimestamp(r[0]).isoformat(), r[9], r[3], r[4]) for r in rows])
+
+    ROLLUP_FIELDS = ('aqi', 'pm25', 'pm10')
+    ROLLUP_COLS = [f"{f}_{s}" for f in ROLLUP_FIELDS for s in ('n', 'sum', 'min', 'max')]
+    PERIODS = {'day': lambda d: d, 'week': lambda d: d - datetime.timedelta(days=d.weekday()), 'month': lambda d: d.replace(day=1)}
+
+    @classmethod
+    def _buckets(cls, samples, periods=PERIODS):
+        """(date, aqi, pm25, pm10) samples -> {(period, bucket): [n, then per field n/sum/min/max]};
+        a missing or non-numeric value leaves its field's count alone"""
+        acc = {}
+        for date, *vals in samples:
+            try: d = datetime.date.fromisoformat(str(date))
+            except ValueError: continue
+            vals = [_num(v) for v in vals]
+            for p, bucket in periods.items():
+                a = acc.get((p, bucket(d)))
+                if a is None: a = acc[(p, bucket(d))] = [0] + [0, 0.0, None, None] * len(vals)
+                a[0] += 1
+                for i, v in enumerate(vals):
+                    if v is None: continue
+                    j = 1 + 4 * i
+                    a[j] += 1; a[j+1] += v
+                    a[j+2] = v if a[j+2] is None else min(a[j+2], v)
+                    a[j+3] = v if a[j+3] is None else max(a[j+3], v)
+        return acc
+
+    def _roll(self, c, samples):
+        """Folds (date, aqi, pm25, pm10) reading samples into the day/week/month rollups, one upsert per touched bucket"""
+        cols = self.ROLLUP_COLS
+        upd = ", ".join(f"{k}={k}+excluded.{k}" if k.endswith(('_sum', '_n')) else
+                        f"{k}=COALESCE({k[-3:]}({k}, excluded.{k}), {k}, excluded.{k})" for k in cols)  # min/max of NULL is NULL
+        c.executemany(f"INSERT INTO rollups (period, bucket, n, {', '.join(cols)}) VALUES (?,?,{','.join('?' * (len(cols) + 1))}) "
+                      f"ON CONFLICT(period, bucket) DO UPDATE SET n=n+excluded.n, {upd}",
+                      [(p, b.isoformat(), *a) for (p, b), a in self._buckets(samples).items()])
+
+    def rollups(self, period, start):
+        """Reading rollups from `start` with each day's flight upload (daily_aqi) folded in as one more sample"""
+        out = {r['bucket']: dict(r) for r in self.conn().execute("SELECT * FROM rollups WHERE period = ? AND bucket >= ?", (period, start))}
+        days = self.conn().execute("SELECT date, aqi, pm25, pm10 FROM daily_aqi WHERE date >= ?", (start,)).fetchall()
+        for (_, b), a in self._buckets(days, {period: self.PERIODS[period]}).items():
+            r = out.setdefault(b.isoformat(), {"period": period, "bucket": b.isoformat(), "n": 0, **{k: None for k in self.ROLLUP_COLS}})
+            r['n'] += a[0]
+            for f, (n, total, lo, hi) in zip(self.ROLLUP_FIELDS, zip(*[iter(a[1:])] * 4)):
+                if not n: continue
+                r[f + '_n'], r[f + '_sum'] = (r[f + '_n'] or 0) + n, (r[f + '_sum'] or 0) + total
+                r[f + '_min'] = lo if r[f + '_min'] is None else min(r[f + '_min'], lo)
+                r[f + '_max'] = hi if r[f + '_max'] is None else max(r[f + '_max'], hi)
+        return [out[b] for b in sorted(out)]
+
+    def create_job(self, job_id, filename, date, sha256):
+        now = time.time()
+        with self.conn() as c:
+            c.execute("INSERT INTO jobs (id, status, filename, date, created, updated, sha256) VALUES (?,'queued',?,?,?,?,?)", (job_id, filename, date, now, now, sha256))
+
+    def update_job(self, job_id, **fields):
+        if 'result' in fields: fields['result'] = app.json.dumps(fields['result'])
+        cols = ", ".join(f"{k}=?" for k in fields)
+        with self.conn() as c: c.execute(f"UPDATE jobs SET {cols}, updated=? WHERE id=?", (*fields.values(), time.time(), job_id))
+
+    def get_job(self, job_id, stale=JOB_STALE_S):
+        # A job whose worker died (pool crash, restart) never updates again: fail it instead of leaving it running
+        q = "SELECT id AS job_id, status, filename, date, rows, created, updated, result, error, sha256 FROM jobs WHERE id = ?"
+        r = self.conn().execute(q, (job_id,)).fetchone()
+        if r is None: return None
+        now = time.time()
+        if r['status'] in ('queued', 'running') and r['updated'] < now - stale:  # polls only write once a job is stale
+            with self.conn() as c:
+                c.execute("UPDATE jobs SET status='error', error='Upload job stopped responding', updated=? "
+                          "WHERE id=? AND status IN ('queued','running') AND updated < ?", (now, job_id, now - stale))
+            r = self.conn().execute(q, (job_id,)).fetchone()
+        job = dict(r)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def put_file(self, name, digest, size):
+        with self.conn() as c:
+            c.execute("INSERT INTO files (name, sha256, size, updated) VALUES (?,?,?,?) ON CONFLICT(name) DO UPDATE SET "
+                      "sha256=excluded.sha256, size=excluded.size, updated=excluded.updated", (name, digest, size, time.time()))
+
+    def file_digest(self, name):
+        # Latest file uploaded under `name`: only for bare /uploads/<name> links; upload rows carry their own sha256
+        r = self.conn().execute("SELECT sha256 FROM files WHERE name = ?", (name,)).fetchone()
+        return r[0] if r else None
+
+    def put_metrics(self, pid, data):
+        with self.conn() as c:
+            c.execute("INSERT INTO metrics (pid, updated, data) VALUES (?,?,?) ON CONFLICT(pid) DO UPDATE SET updated=excluded.updated, data=excluded.data", (pid, time.time(), data))
+
+    def all_metrics(self, max_age=86400):
+        """Latest snapshot per process; rows from processes silent for max_age are dropped"""
+        with self.conn() as c: c.execute("DELETE FROM metrics WHERE updated < ?", (time.time() - max_age,))
+        return [(r['pid'], r['updated'], json.loads(r['data'])) for r in self.conn().execute("SELECT * FROM metrics")]
+
+    # geocache.name '' records a provider answer with no address; it is retried once older than retry_after
+    def geocode_get(self, key, retry_after=86400):
+        r = self.conn().execute("SELECT name, claimed FROM geocache WHERE key = ?", (key,)).fetchone()
+        if r is None or (r[0] == '' and r[1] < time.time() - retry_after): return None
+        return r[0]
+
+    def geocode_claim(self, key, stale=60, retry_after=86400):
+        """True if this caller should resolve key: no cached name and no fresh claim by another worker"""
+        now = time.time()
+        with self.conn() as c:
+            return c.execute("INSERT INTO geocache (key, claimed) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET claimed=excluded.claimed "
+                             "WHERE (name IS NULL AND claimed < ?) OR (name = '' AND claimed < ?)",
+                             (key, now, now - stale, now - retry_after)).rowcount == 1
+
+    def geocode_put(self, key, name):
+        with self.conn() as c:
+            c.execute("INSERT INTO geocache (key, name, claimed) VALUES (?,?,?) ON CONFLICT(key) DO UPDATE SET "
+                      "name=excluded.name, claimed=excluded.claimed", (key, name, time.time()))
+
+    def geocode_release(self, key):
+        with self.conn() as c: c.execute("DELETE FROM geocache WHERE key = ? AND name IS NULL", (key,))
+
+    def next_geocode_slot(self, interval):
+        """Reserves the next provider call time, spaced `interval` seconds apart across all workers"""
+        c = self.conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            r = c.execute("SELECT next_at FROM geo_rate WHERE id = 1").fetchone()
+            slot = max(time.time(), r[0] if r else 0)
+            c.execute("INSERT INTO geo_rate (id, next_at) VALUES (1, ?) ON CONFLICT(id) DO UPDATE SET next_at=excluded.next_at", (slot + interval,))
+            c.commit()
+        except BaseException:
+            c.rollback()
+            raise
+        return slot
+
+    def recent_uploads(self, limit=HISTORY_LIMIT):
+        return [dict(r) for r in self.conn().execute("SELECT id, date, filename, status, aqi, sha256 FROM uploads ORDER BY id DESC LIMIT ?", (limit,))]
+
+    def upload_file(self, ref):
+        """(filename, sha256) of the upload with row id or content digest `ref`; None if unknown or recorded without a digest"""
+        col = 'id' if ref.isdigit() else 'sha256'
+        r = self.conn().execute(f"SELECT filename, sha256 FROM uploads WHERE {col} = ? AND sha256 IS NOT NULL ORDER BY id DESC LIMIT 1", (ref,)).fetchone()
+        return tuple(r) if r else None
+
+    def reading_frames(self, start=0, end=float('inf'), device=None, chunk_rows=50000):
+        """readings as DataFrames of at most chunk_rows rows, oldest first (always at least one frame)"""
+        q, args = "SELECT ts, device, pm1, pm25, pm10, temp, hum, lat, lon, aqi FROM readings WHERE ts >= ? AND ts <= ?", [start, end]
+        if device is not None: q, args = q + " AND device = ?", args + [device]
+        empty = True
+        for df in pd.read_sql_query(q + " ORDER BY ts", self.conn(), params=args, chunksize=chunk_rows):
+            empty = False
+            yield df
+        if empty: yield pd.DataFrame(columns=['ts', 'device', 'pm1', 'pm25', 'pm10', 'temp', 'hum', 'lat', 'lon', 'aqi'])
+
+    def last_reading_id(self):
+        return self.conn().execute("SELECT MAX(id) FROM readings").fetchone()[0] or 0
+
+store = Store(DB_PATH)
+
+# --- SHARED STATE ---
+# current_data is this worker's cached copy of a versioned document held by the state backend.
+# 'sqlite' (default) keeps every gunicorn worker coherent; 'memory' is per-process (single worker / dev).
+STATE_BACKEND = os.environ.get('SKYSENSE_STATE', 'sqlite')
+STATE_KEY = 'current_data'
+SSE_POLL = float(os.environ.get('SKYSENSE_SSE_POLL', 1.0))
+SSE_MAX = int(os.environ.get('SKYSENSE_SSE_MAX', 4))  # open streams per worker; keep below the gthread thread count
+SSE_LIFETIME = float(os.environ.get('SKYSENSE_SSE_LIFETIME', 300))  # seconds before a stream closes and the client reconnects
+
+class StateTxn:
+    def __init__(self, version, value): self.version, self.value, self.new = version, value, None
+
+class MemoryState:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.docs = {}
+
+    def version(self, key): return self.docs.get(key, (0, None))[0]
+    def read(self, key): return self.docs.get(key, (0, None))
+    def scan(self, prefix): return sorted((k, v[0]) for k, v in list(self.docs.items()) if k.startswith(prefix))
+
+    @contextmanager
+    def transaction(self, key):
+        with self.lock:
+            tx = StateTxn(*self.read(key))
+            yield tx
+            if tx.new is not None:
+                tx.version += 1
+                self.docs[key] = (tx.version, tx.new)
+
+class SqliteState(SqliteConnections):
+    """Versioned JSON documents; BEGIN IMMEDIATE serializes writers across processes"""
+    def __init__(self, path):
+        super().__init__(path)
+        with self.conn() as c: c.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, version INTEGER NOT NULL, value TEXT)")
+
+    def version(self, key):
+        r = self.conn().execute("SELECT version FROM state WHERE key = ?", (key,)).fetchone()
+        return r[0] if r else 0
+
+    def read(self, key):
+        r = self.conn().execute("SELECT version, value FROM state WHERE key = ?", (key,)).fetchone()
+        return (r[0], r[1]) if r else (0, None)
+
+    def scan(self, prefix):
+        """(key, version) of every document under prefix, as a primary-key range scan"""
+        return [tuple(r) for r in self.conn().execute("SELECT key, version FROM state WHERE key >= ? AND key < ? ORDER BY key", (prefix, prefix + '\uffff'))]
+
+    @contextmanager
+    def transaction(self, key):
+        c = self.conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            tx = StateTxn(*self.read(key))
+            yield tx
+            if tx.new is not None:
+                tx.version += 1
+                c.execute("INSERT INTO state (key, version, value) VALUES (?,?,?) ON CONFLICT(key) DO UPDATE SET version=excluded.version, value=excluded.value", (key, tx.version, tx.new))
+            c.commit()
+        except BaseException:
+            c.rollback()
+            raise
+
+state = SqliteState(DB_PATH) if STATE_BACKEND == 'sqlite' else MemoryState()
+state_lock = threading.RLock()
+state_changed = threading.Condition()  # wakes this worker's SSE streams after a local commit
+sse_slots = threading.BoundedSemaphore(SSE_MAX)
+state_version = 0
+field_versions = {}  # field -> state version that last changed it (drives ?since= deltas)
+field_json = {}      # field -> its JSON as of state_version
+
+def encode_field(v):
+    # Health bands are shared constants with pre-encoded JSON
+    return HEALTH_JSON.get(id(v)) or app.json.dumps(v)
+
+def _load_state(text):
+    doc = json.loads(text)
+    saved = doc['data']
+    chart = saved.pop('chart_data', {})
+    saved['health_risks'] = shared_band(saved.get('health_risks'))
+    current_data.update(saved)
+    current_data['chart_data'] = ChartBuffer(chart.get('aqi', []), chart.get('gps', []))
+    rolling.load(doc.get('rolling'))
+    field_versions.clear(); field_versions.update(doc['fields'])
+    field_json.clear(); field_json.update({k: encode_field(v) for k, v in current_data.items()})
+
+def sync_state():
+    """Pulls a newer committed state into current_data; call with state_lock held"""
+    global state_version
+    if not field_json: field_json.update({k: encode_field(v) for k, v in current_data.items()})
+    if state.version(STATE_KEY) == state_version: return
+    v, text = state.read(STATE_KEY)
+    if text: _load_state(text)
+    state_version = v
+
+@contextmanager
+def state_txn(touch=()):
+    """Atomic read-modify-write of current_data, coherent across threads and workers.
+    touch names derived fields (e.g. 'history') whose source changed outside current_data."""
+    global state_version
+    with state_lock:
+        saved = None
+        try:
+            with state.transaction(STATE_KEY) as tx:
+                if tx.version != state_version and tx.value: _load_state(tx.value)
+                if not field_json: field_json.update({k: encode_field(v) for k, v in current_data.items()})
+                saved = ','.join(f"{json.dumps(k)}:{js}" for k, js in field_json.items()), json.dumps(field_versions), rolling.encode()
+                yield current_data
+                # Each field is encoded once; comparing encodings tells which fields changed
+                new_v, parts = tx.version + 1, {k: encode_field(v) for k, v in current_data.items()}
+                for k in [k for k, js in parts.items() if field_json.get(k) != js] + list(touch): field_versions[k] = new_v
+                body = ','.join(f"{json.dumps(k)}:{js}" for k, js in parts.items())
+                tx.new = f'{{"data":{{{body}}},"fields":{json.dumps(field_versions)},"rolling":{rolling.encode()}}}'
+            state_version = tx.version
+            field_json.clear(); field_json.update(parts)
+        except BaseException:
+            # Put back what the body started from (there may be no committed document to reload yet),
+            # then reload on next access in case another worker committed meanwhile
+            if saved: _load_state('{"data":{%s},"fields":%s,"rolling":%s}' % saved)
+            state_version = -1
+            raise
+    with state_changed: state_changed.notify_all()
+
+@timed('encode')
+def encode_payload(since=None):
+    """/api/data body assembled from the per-field encodings of state_version: the full dashboard,
+    or {version, changes} with the fields changed after `since` (all of them when since is 0 or unknown)"""
+    full = since is None or not (0 < since <= state_version)
+    parts = [(k, js) for k, js in field_json.items() if full or field_versions.get(k, 0) > since]
+    if full or field_versions.get('history', 0) > since: parts.append(('history', app.json.dumps(store.recent_uploads())))
+    body = '{' + ','.join(f"{json.dumps(k)}:{js}" for k, js in parts) + '}'
+    return (body if since is None else f'{{"version":{state_version},"changes":{body}}}').encode()
+
+class ResponseCache:
+    """Encoded response bodies for a single state version; the first request at a new version drops them all"""
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.version, self.bodies = None, {}
+
+    def get(self, version, key, build):
+        if version != self.version or len(self.bodies) >= self.max_entries: self.version, self.bodies = version, {}
+        body = self.bodies.get(key)
+        if body is None: body = self.bodies[key] = build()
+        return body
+
+response_cache = ResponseCache()
+GZIP_MIN_BYTES = 1024
+
 # --- PRECISE AQI CALCULATION (INDIAN STANDARD) ---
 def get_subindex_pm25(x):
     if x <= 30: return x * 50 / 30
@@ -59,21 +657,260 @@ def calculate_aqi(pm25, pm10):
     except:
         return 0
 
+# --- VECTORIZED AQI ENGINE ---
+# Same bands and arithmetic as the scalar functions above: lo + (x - c) * num / den,
+# band picked with a breakpoint lookup. PM10's first two bands use 1/1 so x stays exact.
+PM25_UPPER = np.array([30, 60, 90, 120, 250], dtype=float)
+PM25_COEF = np.array([(0, 0, 50, 30), (30, 50, 50, 30), (60, 100, 100, 30), (90, 200, 100, 30), (120, 300, 100, 130), (250, 400, 100, 130)], dtype=float)
+PM10_UPPER = np.array([50, 100, 250, 350, 430], dtype=float)
+PM10_COEF = np.array([(0, 0, 1, 1), (50, 50, 1, 1), (100, 100, 100, 150), (250, 200, 100, 100), (350, 300, 100, 80), (430, 400, 100, 80)], dtype=float)
+
+def _subindex_array(x, upper, coef):
+    c, lo, num, den = coef[np.searchsorted(upper, x, side='left')].T
+    return lo + (x - c) * num / den
+
+def _float_array(values):
+    """Returns (floats, bad) where bad marks entries float() would have rejected."""
+    arr = np.asarray(values)
+    if arr.dtype.kind in 'biuf': return arr.astype(float), np.zeros(arr.shape, dtype=bool)
+    out, bad = np.empty(arr.shape), np.zeros(arr.shape, dtype=bool)
+    for i, v in enumerate(arr.ravel()):
+        try: out.flat[i] = float(v)
+        except (TypeError, ValueError): out.flat[i], bad.flat[i] = np.nan, True
+    return out, bad
+
+def calculate_aqi_array(pm25, pm10):
+    """Column-wise calculate_aqi: returns an int array with identical values"""
+    p25, bad25 = _float_array(pm25)
+    p10, bad10 = _float_array(pm10)
+    s25 = _subindex_array(p25, PM25_UPPER, PM25_COEF)
+    s10 = _subindex_array(p10, PM10_UPPER, PM10_COEF)
+    # max(a, b) returns b only when b > a, so a NaN PM2.5 sub-index poisons the result
+    m = np.where(s10 > s25, s10, s25)
+    ok = np.isfinite(m) & ~bad25 & ~bad10
+    return np.trunc(np.where(ok, m, 0)).astype(np.int64)
+
+# --- TRACK SIMPLIFICATION ---
+CHART_MIN_MOVE = 0.0001  # degrees on either axis before a GPS point counts as a new chart point
+CHART_MAX_POINTS = int(os.environ.get('SKYSENSE_CHART_POINTS', 200))
+
+def simplify_track(pts, max_points=CHART_MAX_POINTS):
+    """Douglas-Peucker on [lat, lon, aqi] points, splitting the worst segment first and stopping at max_points"""
+    n = len(pts)
+    if n <= max_points: return pts
+    y = np.array([p[0] for p in pts])
+    x = np.array([p[1] for p in pts]) * math.cos(math.radians(y[0]))
+
+    def split(i, j):
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        px, py = x[i+1:j] - x[i], y[i+1:j] - y[i]
+        # Distance to the segment (not the infinite line), so back-and-forth runs still split evenly
+        t = np.clip((px * dx + py * dy) / (dx * dx + dy * dy), 0, 1) if dx or dy else 0
+        d = np.hypot(px - t * dx, py - t * dy)
+        k = int(d.argmax())
+        return (-d[k], i, j, i + 1 + k if d[k] > 0 else (i + j) // 2)
+
+    keep, heap = [0, n - 1], [split(0, n - 1)]
+    while heap and len(keep) < max_points:
+        _, i, j, m = heapq.heappop(heap)
+        keep.append(m)
+        for a, b in ((i, m), (m, j)):
+            if b - a >= 2: heapq.heappush(heap, split(a, b))
+    keep = np.sort(keep)
+    # Each kept point carries the worst AQI of the points it stands in for
+    worst = np.maximum.reduceat(np.array([p[2] for p in pts]), keep)
+    return [[pts[k][0], pts[k][1], q] for k, q in zip(keep.tolist(), worst.tolist())]
+
+class FlightAccumulator:
+    """GPS filter, running means and a bounded chart track for a flight, fed one frame (or chunk) at a time"""
+    FIELDS = ('pm1', 'pm25', 'pm10', 'temp', 'hum')
+
+    def __init__(self):
+        self.sums, self.counts = {}, {}
+        self.track = []  # [lat, lon, aqi] chart points
+        self.rows = 0
+
+    def add(self, df):
+        self.rows += len(df)
+        if 'lat' not in df.columns: return
+        valid = df[(df['lat'] != 0).to_numpy()]
+        if valid.empty: return
+        for k in self.FIELDS:
+            if k in valid.columns:
+                self.sums[k] = self.sums.get(k, 0) + valid[k].sum()
+                self.counts[k] = self.counts.get(k, 0) + valid[k].count()
+
+        # Distance threshold against the previous kept point; rows that have not moved fold into it,
+        # keeping the worst AQI so short spikes survive thinning
+        track = self.track
+        aqi = calculate_aqi_array(valid['pm25'], valid['pm10']).tolist()
+        for a, b, q in zip(valid['lat'].tolist(), valid['lon'].tolist(), aqi):
+            last = track[-1] if track else None
+            if last and abs(a - last[0]) <= CHART_MIN_MOVE and abs(b - last[1]) <= CHART_MIN_MOVE:
+                if q > last[2]: last[2] = q
+            else:
+                track.append([a, b, q])
+                # Keep memory bounded on long flights by compacting before the final pass
+                if len(track) > 10 * CHART_MAX_POINTS: track = self.track = simplify_track(track, 2 * CHART_MAX_POINTS)
+
+    def result(self):
+        if not self.track: raise ValueError("No GPS Data")
+        stats = {k: (round(self.sums[k] / self.counts[k] if self.counts[k] else float('nan'), 1) if k in self.sums else 0) for k in self.FIELDS}
+        pts = simplify_track(self.track)
+        stats.update({
+            "aqi": calculate_aqi(stats['pm25'], stats['pm10']),
+            "lat": self.track[0][0], "lon": self.track[0][1],
+            "chart_aqi": [p[2] for p in pts], "chart_gps": [{"lat": p[0], "lon": p[1]} for p in pts],
+        })
+        return stats
+
+# --- ROLLING AVERAGES ---
+# The Indian AQI is defined on 24-hour means. Live readings fold into ROLLING_BUCKET_S buckets and every
+# window keeps a running sum/count, so a reading is O(1) and buckets are subtracted as they expire.
+ROLLING_BUCKET_S = int(os.environ.get('SKYSENSE_ROLLING_BUCKET', 300))
+ROLLING_WINDOWS = (('1h', 3600), ('8h', 8 * 3600), ('24h', 24 * 3600))
+
+class RollingMeans:
+    """Time-bucketed 1h/8h/24h means of the live sensor fields"""
+    FIELDS = ('pm1', 'pm25', 'pm10', 'temp', 'hum')
+
+    def __init__(self, bucket_s=ROLLING_BUCKET_S, windows=ROLLING_WINDOWS):
+        self.bucket_s = bucket_s
+        self.windows = [(name, max(1, secs // bucket_s)) for name, secs in windows]
+        self.size = max(n for _, n in self.windows)
+        self.reset()
+
+    def reset(self):
+        nf = len(self.FIELDS)
+        self.head = -1                 # newest bucket number seen
+        self.ids = [-1] * self.size    # bucket number held by each ring slot
+        self.sums = [[0.0] * nf for _ in range(self.size)]
+        self.counts = [[0] * nf for _ in range(self.size)]
+        self.totals = {name: ([0.0] * nf, [0] * nf) for name, _ in self.windows}
+        self.enc = {}                  # slot -> cached JSON, so a state write re-encodes only touched slots
+
+    def _fold(self, name, slot, sign):
+        ts, tc = self.totals[name]
+        for i, (s, c) in enumerate(zip(self.sums[slot], self.counts[slot])): ts[i] += sign * s; tc[i] += sign * c
+
+    def _open_window(self, head):
+        # Every bucket in the ring's span starts empty (not unknown), so late readings for it still land
+        self.head = head
+        for nb in range(max(0, head - self.size + 1), head + 1): self.ids[nb % self.size] = nb
+
+    def _advance(self, b):
+        if self.head < 0 or b - self.head >= self.size:
+            self.reset()
+            return self._open_window(b)
+        for nb in range(self.head + 1, b + 1):
+            for name, n in self.windows:
+                old = nb - n  # leaves this window as nb enters it
+                if old >= 0 and self.ids[old % self.size] == old: self._fold(name, old % self.size, -1)
+            slot = nb % self.size
+            self.ids[slot] = nb
+            self.sums[slot], self.counts[slot] = [0.0] * len(self.FIELDS), [0] * len(self.FIELDS)
+            self.enc.pop(slot, None)
+        self.head = max(self.head, b)
+
+    def add(self, ts, d):
+        b = int(ts // self.bucket_s)
+        self._advance(b)
+        slot = b % self.size
+        if self.ids[slot] != b: return  # older than the longest window
+        vals = []
+        for i, k in enumerate(self.FIELDS):
+            try: v = float(d.get(k))
+            except (TypeError, ValueError): continue
+            if math.isfinite(v): vals.append((i, v))
+        for i, v in vals: self.sums[slot][i] += v; self.counts[slot][i] += 1
+        for name, n in self.windows:
+            if b > self.head - n:
+                ts_, tc = self.totals[name]
+                for i, v in vals: ts_[i] += v; tc[i] += 1
+        self.enc.pop(slot, None)
+
+    def means(self):
+        return {name: {k: (round(s / c, 1) if c else None) for k, s, c in zip(self.FIELDS, *self.totals[name])} for name, _ in self.windows}
+
+    def encode(self):
+        parts = []
+        for slot, b in enumerate(self.ids):
+            if b < 0 or not any(self.counts[slot]): continue
+            js = self.enc.get(slot)
+            if js is None: js = self.enc[slot] = json.dumps([b, *self.sums[slot], *self.counts[slot]])
+            parts.append(js)
+        return f'{{"bucket":{self.bucket_s},"head":{self.head},"slots":[{",".join(parts)}]}}'
+
+    def load(self, doc):
+        self.reset()
+        if not doc or doc.get('bucket') != self.bucket_s: return
+        nf = len(self.FIELDS)
+        self._open_window(doc['head'])
+        for b, *vals in doc['slots']:
+            if b <= self.head - self.size: continue
+            slot = b % self.size
+            self.ids[slot], self.sums[slot], self.counts[slot] = b, vals[:nf], vals[nf:]
+            for name, n in self.windows:
+                if b > self.head - n: self._fold(name, slot, 1)
+
+rolling = RollingMeans()
+
 # --- BACKEND HELPERS ---
-def has_moved(lat, lon):
-    gps = current_data['chart_data']['gps']
-    if not gps: return True 
-    return (abs(lat - gps[-1]['lat']) > 0.0001 or abs(lon - gps[-1]['lon']) > 0.0001)
+SENSOR_FIELDS = ('pm1', 'pm25', 'pm10', 'temp', 'hum', 'lat', 'lon')  # reading keys copied into state
+
+def has_moved(chart, lat, lon):
+    last = chart.last_gps()
+    if not last: return True 
+    return (abs(lat - last['lat']) > CHART_MIN_MOVE or abs(lon - last['lon']) > CHART_MIN_MOVE)
+
+def fold_reading(cd, roll, d, ts):
+    """Folds one reading into a state dict and its RollingMeans; returns the reading's instantaneous AQI.
+    aqi/avg_* follow the 24h means; chart points keep the instantaneous AQI."""
+    aqi = calculate_aqi(d.get('pm25',0), d.get('pm10',0))
+    prev = (cd['lat'], cd['lon'])
+    cd.update({k: d[k] for k in SENSOR_FIELDS if k in d})
+    roll.add(ts, d)
+    means = cd['rolling'] = roll.means()
+    for k, v in means['24h'].items(): cd['avg_' + k] = v if v is not None else 0
+    cd['aqi'] = cd['avg_aqi'] = calculate_aqi(cd['avg_pm25'], cd['avg_pm10'])
+    cd['health_risks'] = calc_health({"pm25": cd['avg_pm25'], "pm10": cd['avg_pm10']})
+    lat, lon = d.get('lat',0), d.get('lon',0)
+    if has_moved(cd['chart_data'], lat, lon) and lat != 0: cd['chart_data'].append(aqi, lat, lon)
+    if lat != 0 and (geo_key(lat, lon) != geo_key(*prev) or cd['location_name'] == "Updating..."): cd['location_name'] = resolve_location(lat, lon)
+    return aqi
+
+def reading_time(d):
+    """The reading's own epoch-seconds 'ts' (a buffered device reading), never later than now; else now"""
+    now = time.time()
+    if d.get('ts') is None: return now
+    try: ts = float(d['ts'])
+    except (TypeError, ValueError): ts = math.nan
+    if not math.isfinite(ts) or ts <= 0: raise ValueError("ts must be a Unix timestamp in seconds")
+    return min(ts, now)
+
+def apply_reading(d, ts):
+    """Folds one untagged ESP32 reading (taken at ts, see reading_time) into current_data; returns its readings-table row.
+    A reading naming a device only gets its AQI here: it folds into that device's document, which show_device mirrors."""
+    device = d.get('device')
+    if device is None:
+        aqi = fold_reading(current_data, rolling, d, ts)
+        current_data['device'] = None
+    else: aqi = calculate_aqi(d.get('pm25',0), d.get('pm10',0))
+    return (ts, str(device) if device is not None else None, d.get('pm1'), d.get('pm25'), d.get('pm10'), d.get('temp'), d.get('hum'), d.get('lat',0), d.get('lon',0), aqi)
+
+def iter_readings(req):
+    """Readings from a JSON array/object body or an NDJSON stream, one line at a time"""
+    if req.is_json:
+        body = req.get_json()
+        yield from (body if isinstance(body, list) else [body])
+        return
+    for line in req.stream:
+        if line.strip(): yield json.loads(line)
 
 def read_file_safely(file):
-    file.seek(0)
-    try: return pd.read_csv(file)
-    except: pass
-    try: file.seek(0); return pd.read_csv(file, encoding='latin1')
-    except: pass
-    try: file.seek(0); return pd.read_excel(file)
-    except: pass
-    raise ValueError("Invalid File Format")
+    fmt, enc = sniff_format(file)
+    try: return pd.read_csv(file, encoding=enc) if fmt == 'csv' else pd.read_excel(file)
+    except Exception: raise ValueError("Invalid File Format")
 
 def normalize_columns(df):
     col_map = {}
@@ -88,76 +925,614 @@ def normalize_columns(df):
         elif 'lon' in cl: col_map[c] = 'lon'
     return df.rename(columns=col_map)
 
+# --- STREAMING INGEST ---
+CHUNK_ROWS = int(os.environ.get('SKYSENSE_CHUNK_ROWS', 50000))
+
+def sniff_format(fh):
+    """Detects format and encoding once from the file header: ('csv'|'xlsx'|'xls', encoding)"""
+    fh.seek(0)
+    head = fh.read(64 * 1024)
+    fh.seek(0)
+    if head.startswith(b'PK\x03\x04'): return 'xlsx', None
+    if head.startswith(b'\xd0\xcf\x11\xe0'): return 'xls', None
+    try: codecs.getincrementaldecoder('utf-8')().decode(head, final=False); return 'csv', 'utf-8'
+    except UnicodeDecodeError: return 'csv', 'latin1'
+
+def iter_frames(fh, fmt, enc=None, chunk_rows=CHUNK_ROWS):
+    """Yields the file as DataFrames of at most chunk_rows rows"""
+    if fmt == 'csv':
+        yield from pd.read_csv(fh, encoding=enc, encoding_errors='replace', chunksize=chunk_rows)
+    elif fmt == 'xlsx':
+        wb = openpyxl.load_workbook(fh, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None: return
+            cols = [c if c is not None else f"Unnamed: {i}" for i, c in enumerate(header)]
+            batch = []
+            for r in rows:
+                if all(v is None for v in r): continue
+                batch.append(r)
+                if len(batch) >= chunk_rows: yield pd.DataFrame(batch, columns=cols); batch = []
+            if batch: yield pd.DataFrame(batch, columns=cols)
+        finally: wb.close()
+    else:
+        yield pd.read_excel(fh)  # legacy .xls has no row streaming reader
+
+def parse_frames(path):
+    """Normalized numeric frames of a CSV/Excel file, CHUNK_ROWS at a time"""
+    with open(path, 'rb') as fh:
+        fmt, enc = sniff_format(fh)
+        frames = iter_frames(fh, fmt, enc)
+        while True:
+            try: chunk = next(frames, None)
+            except Exception: raise ValueError("Invalid File Format")
+            if chunk is None: return
+            yield numeric_frame(normalize_columns(chunk))
+
+def ingest_file(path, progress=None, digest=None):
+    """Streams a saved flight file through FlightAccumulator with flat peak memory; progress(rows) after each chunk.
+    With a content digest the parsed sidecar is replayed when present and written otherwise."""
+    acc = FlightAccumulator()
+    if digest is None: frames = parse_frames(path)
+    elif has_parsed(digest): frames = iter_parsed(digest)
+    else: frames = write_parsed(digest, parse_frames(path))
+    for chunk in frames:
+        acc.add(chunk)
+        if progress: progress(acc.rows)
+    result = acc.result()
+    result['rows'] = acc.rows
+    return result
+
+# --- CONTENT-ADDRESSED UPLOADS ---
+# Upload bytes live at uploads/objects/<sha256>, so equal files are stored once and a reused name never
+# clobbers an older flight: upload and job rows record the sha256 they were stored under. Next to each
+# object sits <sha256>.cols/: one raw float64 file per sensor column of the normalized frame plus meta.json,
+# which lets duplicates and re-analysis skip CSV/Excel parsing.
+OBJECT_DIR = os.path.join(UPLOAD_FOLDER, 'objects')
+os.makedirs(OBJECT_DIR, exist_ok=True)
+PARSED_COLUMNS = ('pm1', 'pm25', 'pm10', 'temp', 'hum', 'lat', 'lon')
+
+def object_path(digest): return os.path.join(OBJECT_DIR, digest)
+def parsed_dir(digest): return os.path.join(OBJECT_DIR, digest + '.cols')
+def has_parsed(digest): return os.path.exists(os.path.join(parsed_dir(digest), 'meta.json'))
+
+def numeric_frame(df):
+    """The sensor columns of a normalized frame as float64 (unparseable cells become NaN)"""
+    df = df.loc[:, ~df.columns.duplicated()]
+    return pd.DataFrame({c: pd.to_numeric(df[c], errors='coerce').astype(float) for c in PARSED_COLUMNS if c in df.columns}, index=df.index)
+
+def save_object(fh):
+    """Copies a file object into the object store; returns (sha256, size)"""
+    h, size = hashlib.sha256(), 0
+    fd, tmp = tempfile.mkstemp(dir=OBJECT_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                h.update(block); out.write(block); size += len(block)
+        digest = h.hexdigest()
+        if os.path.exists(object_path(digest)): os.remove(tmp)
+        else: os.replace(tmp, object_path(digest))
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return digest, size
+
+def write_parsed(digest, frames):
+    """Passes frames through while appending their columns to a new sidecar, published once complete"""
+    tmp = tempfile.mkdtemp(dir=OBJECT_DIR)
+    files, rows = {}, 0
+    try:
+        for df in frames:
+            for c in df.columns:
+                if c not in files: files[c] = open(os.path.join(tmp, c + '.f64'), 'wb')
+                df[c].to_numpy('<f8').tofile(files[c])
+            rows += len(df)
+            yield df
+        for fh in files.values(): fh.close()
+        with open(os.path.join(tmp, 'meta.json'), 'w') as fh: json.dump({"rows": rows, "columns": list(files)}, fh)
+        try: os.rename(tmp, parsed_dir(digest))
+        except OSError: pass  # another worker published the same sidecar first
+    finally:
+        for fh in files.values(): fh.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def iter_parsed(digest, chunk_rows=CHUNK_ROWS):
+    """Replays a sidecar as numeric frames of at most chunk_rows rows"""
+    d = parsed_dir(digest)
+    with open(os.path.join(d, 'meta.json')) as fh: meta = json.load(fh)
+    files = {c: open(os.path.join(d, c + '.f64'), 'rb') for c in meta['columns']}
+    try:
+        for start in range(0, meta['rows'], chunk_rows):
+            n = min(chunk_rows, meta['rows'] - start)
+            yield pd.DataFrame({c: np.fromfile(fh, '<f8', count=n) for c, fh in files.items()}, index=pd.RangeIndex(start, start + n))
+    finally:
+        for fh in files.values(): fh.close()
+
+# --- OFFLINE REVERSE GEOCODER ---
+GEOCODE_MAX_KM = 25  # farther than this from every gazetteer place -> plain coordinates
+
+class PlaceIndex:
+    """Nearest-place lookup over a gazetteer, indexed by a grid of CELL_DEG-degree cells"""
+    CELL_DEG = 0.1
+
+    def __init__(self, names, lats, lons):
+        self.names = list(names)
+        self.lat, self.lon = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        ci = np.floor(self.lat / self.CELL_DEG).astype(int)
+        cj = np.floor(self.lon / self.CELL_DEG).astype(int)
+        cells = {}
+        for i, key in enumerate(zip(ci.tolist(), cj.tolist())): cells.setdefault(key, []).append(i)
+        self.cells = {k: np.array(v) for k, v in cells.items()}
+
+    @staticmethod
+    def _ring(ci, cj, r):
+        if r == 0: return [(ci, cj)]
+        return ([(ci + a, cj + b) for a in (-r, r) for b in range(-r, r + 1)] +
+                [(ci + a, cj + b) for a in range(-r + 1, r) for b in (-r, r)])
+
+    def nearest(self, lat, lon, max_km=GEOCODE_MAX_KM):
+        c = self.CELL_DEG
+        ci, cj = math.floor(lat / c), math.floor(lon / c)
+        coslat = max(math.cos(math.radians(lat)), 0.01)
+        best_i, best_d = -1, math.inf  # equirectangular distance in degrees of latitude
+        for r in range(int(max_km / 111.2 / c / coslat) + 2):
+            # every point in ring r is at least (r - 1) cells away along one axis
+            if best_i >= 0 and (r - 1) * c * coslat > best_d: break
+            cand = [self.cells[k] for k in self._ring(ci, cj, r) if k in self.cells]
+            if not cand: continue
+            idx = np.concatenate(cand)
+            d = np.hypot(self.lat[idx] - lat, (self.lon[idx] - lon) * coslat)
+            j = d.argmin()
+            if d[j] < best_d: best_i, best_d = idx[j], d[j]
+        if best_i < 0 or best_d * 111.2 > max_km: return None
+        return self.names[best_i]
+
+    def nearest_batch(self, lats, lons, max_km=GEOCODE_MAX_KM):
+        """Names for a whole track; points sharing a 3-decimal key are looked up once"""
+        seen, out = {}, []
+        for lat, lon in zip(lats, lons):
+            key = (round(lat, 3), round(lon, 3))
+            if key not in seen: seen[key] = self.nearest(lat, lon, max_km)
+            out.append(seen[key])
+        return out
+
+def load_gazetteer(path):
+    """CSV with name, lat/latitude, lon/lng/longitude [, city] headers, or a GeoNames .txt dump"""
+    if path.endswith('.txt'):
+        df = pd.read_csv(path, sep='\t', header=None, usecols=[1, 4, 5], names=['name', 'lat', 'lon'], quoting=3)
+    else:
+        df = pd.read_csv(path)
+        df = df.rename(columns={c: {'latitude': 'lat', 'lng': 'lon', 'longitude': 'lon'}.get(str(c).lower().strip(), str(c).lower().strip()) for c in df.columns})
+    df = df.dropna(subset=['name', 'lat', 'lon'])
+    names = df['name'].astype(str)
+    if 'city' in df.columns: names = [f"{n}, {c}" if isinstance(c, str) and c else n for n, c in zip(names, df['city'])]
+    return PlaceIndex(names, df['lat'], df['lon'])
+
+gazetteer = load_gazetteer(GAZETTEER_PATH) if GAZETTEER_PATH else None
+
 # --- BACKEND LOCATION FINDER ---
-def get_city_name(lat, lon):
-    if lat == 0 or lon == 0: return "No GPS Signal"
-    key = (round(lat, 3), round(lon, 3))
-    if key in location_cache: return location_cache[key]
-    
-    coord_str = f"{round(lat, 4)}, {round(lon, 4)}"
-    if not geolocator: return coord_str
-    
-    # Try getting name from backend (if not blocked)
-    for _ in range(2): 
+def geo_key(lat, lon): return f"{round(float(lat), 3):.3f},{round(float(lon), 3):.3f}"
+
+def format_address(add, fallback):
+    name = (add.get('neighbourhood') or add.get('suburb') or add.get('village') or add.get('road') or add.get('residential'))
+    city = (add.get('city') or add.get('town') or add.get('county') or add.get('state'))
+    return f"{name}, {city}" if name and city else (name or city or fallback)
+
+# --- BACKGROUND GEOCODING ---
+# Online lookups never run on a request thread: requests get the cached name or "Updating...",
+# and a worker thread fills location_name in when the provider answers.
+GEOCODE_INTERVAL = float(os.environ.get('SKYSENSE_GEOCODE_INTERVAL', 1.0))  # Nominatim policy: 1 req/s
+
+class NominatimProvider:
+    def __init__(self, geolocator): self.geolocator = geolocator
+
+    def reverse(self, lat, lon):
+        loc = self.geolocator.reverse(f"{lat}, {lon}", exactly_one=True, language='en', timeout=5)
+        return format_address(loc.raw.get('address', {}), None) if loc else None
+
+class GeocodeQueue:
+    """Reverse-geocoding job queue. Keys (3-decimal rounding) are coalesced across callers in this
+    process and claimed in the store across workers; provider calls are rate-limited through the store.
+    provider is any object with reverse(lat, lon) -> name or None, so tests can swap in a stub."""
+    def __init__(self, provider, min_interval=GEOCODE_INTERVAL):
+        self.provider, self.min_interval = provider, min_interval
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def lookup(self, lat, lon):
+        """Cached name (memory, then disk), '' if the provider has none, or None; never calls the provider"""
+        key = geo_key(lat, lon)
+        name = location_cache.get(key)
+        if name is None:
+            name = store.geocode_get(key)
+            if name: location_cache.put(key, name)
+        return name
+
+    def submit(self, lat, lon, callback=None):
+        key = geo_key(lat, lon)
+        with self.lock:
+            if self.pid != os.getpid():  # first use in this process, or after a fork
+                self.pid, self.pending, self.q = os.getpid(), {}, queue.Queue()
+                threading.Thread(target=self._run, args=(self.q,), daemon=True).start()
+            if key in self.pending:
+                self.pending[key].append(callback)
+                return
+            self.pending[key] = [callback]
+        self.q.put((key, lat, lon))
+
+    def _run(self, q):
+        while True:
+            key, lat, lon = q.get()
+            name = None
+            try: name = self._resolve(key, lat, lon)
+            except Exception: pass  # e.g. the store was busy; the next reading for this key submits again
+            finally:
+                with self.lock: callbacks = self.pending.pop(key, [])
+            if name is None: continue
+            for cb in callbacks:
+                if cb:
+                    try: cb(key, name or f"{round(lat, 4)}, {round(lon, 4)}")
+                    except Exception: pass
+
+    def _resolve(self, key, lat, lon):
+        name = self.lookup(lat, lon)
+        if name is not None or not self.provider or not store.geocode_claim(key): return name
+        delay = store.next_geocode_slot(self.min_interval) - time.time()
+        if delay > 0: time.sleep(delay)
         try:
-            loc = geolocator.reverse(f"{lat}, {lon}", exactly_one=True, language='en', timeout=5)
-            if loc:
-                add = loc.raw.get('address', {})
-                name = (add.get('neighbourhood') or add.get('suburb') or add.get('village') or add.get('road') or add.get('residential'))
-                city = (add.get('city') or add.get('town') or add.get('county') or add.get('state'))
-                res = f"{name}, {city}" if name and city else (name or city or coord_str)
-                location_cache[key] = res
-                return res
-        except: time.sleep(1)
-    return coord_str
+            with timed('geocode'): name = self.provider.reverse(lat, lon)
+        except Exception:
+            store.geocode_release(key)  # provider error: worth retrying on the next reading
+            return None
+        name = name or ''  # a definite "no address here" is cached too, so it isn't asked again per reading
+        store.geocode_put(key, name)
+        if name: location_cache.put(key, name)
+        return name
+
+geocoder = GeocodeQueue(NominatimProvider(geolocator) if geolocator else None)
 
+def on_geocoded(key, name):
+    # Whichever worker resolves a key fills in the shared state, if the dashboard is still there,
+    # and the device documents waiting on it
+    with state_lock:
+        sync_state()
+        if geo_key(current_data['lat'], current_data['lon']) == key:
+            with state_txn() as cd: cd['location_name'] = name
+    locate_devices(key, name)
+
+@timed('locate')
+def resolve_location(lat, lon):
+    """Place name for the dashboard without blocking: cache or gazetteer now, else queued"""
+    if lat == 0 or lon == 0: return "No GPS Signal"
+    name = geocoder.lookup(lat, lon)
+    if not name and gazetteer: name = gazetteer.nearest(lat, lon) or name
+    metrics.inc("skysense_geocode_cache_hits_total" if name is not None else "skysense_geocode_cache_misses_total")
+    if name: return name
+    if name == '' or GEOCODER_MODE == 'offline' or not geocoder.provider: return f"{round(lat, 4)}, {round(lon, 4)}"
+    geocoder.submit(lat, lon, on_geocoded)
+    return "Updating..."
+
+# --- HEALTH RISK BANDS ---
+# One immutable entry per AQI band (<=100, <=200, <=300, <=400, <=500, above), with its JSON pre-encoded
+HEALTH_UPPER = (100, 200, 300, 400, 500)
+HEALTH_BANDS = (
+    (
+        {"name": "General Well-being", "desc": "Air quality is satisfactory. It is a great day to be active outside.", "prob": 5, "level": "Good", "recs": ["Ventilate your home freely.", "Enjoy outdoor activities.", "No special filtration needed."]},
+        {"name": "Respiratory Health", "desc": "No irritation or respiratory distress expected for the general population.", "prob": 5, "level": "Good", "recs": ["Continue normal exercise routines.", "Deep breathing exercises are safe.", "Enjoy the fresh air."]},
+        {"name": "Sensitive Groups", "desc": "People with asthma or allergies can typically enjoy outdoors.", "prob": 10, "level": "Low", "recs": ["Keep usual rescue inhalers just in case.", "Monitor local pollen levels.", "No masks required."]},
+        {"name": "Skin & Eye Health", "desc": "Clear visibility and low particulate matter mean no irritation.", "prob": 0, "level": "Low", "recs": ["No protective eyewear needed.", "Standard skincare is sufficient.", "Use sunscreen."]},
+    ),
+    (
+        {"name": "Mild Respiratory Irritation", "desc": "Sensitive individuals may experience coughing or minor throat irritation.", "prob": 40, "level": "Moderate", "recs": ["Limit prolonged outdoor exertion.", "Hydrate frequently to soothe throat.", "Carry water when walking outside."]},
+        {"name": "Asthma Aggravation", "desc": "Air quality is acceptable for most, but may trigger mild asthma symptoms.", "prob": 50, "level": "Moderate", "recs": ["Keep inhalers accessible at all times.", "Avoid jogging near heavy traffic.", "Watch for wheezing symptoms."]},
+        {"name": "Sinus Pressure", "desc": "Particulates may cause minor nasal congestion or sinus pressure.", "prob": 30, "level": "Moderate", "recs": ["Consider a saline nasal rinse.", "Shower after coming indoors.", "Keep windows closed during peak traffic."]},
+        {"name": "Fatigue Levels", "desc": "Slight reduction in oxygen efficiency may cause quicker tiredness.", "prob": 25, "level": "Low", "recs": ["Take more breaks during exercise.", "Avoid heavy cardio outdoors.", "Monitor heart rate during activity."]},
+    ),
+    (
+        {"name": "Bronchitis Risk", "desc": "High PM levels can inflame bronchial tubes causing heavy coughing.", "prob": 65, "level": "High", "recs": ["Avoid all outdoor physical activity.", "Wear an N95 mask if outside.", "Use an air purifier in the bedroom."]},
+        {"name": "Cardiac Stress", "desc": "Fine particles entering the bloodstream can slightly elevate blood pressure.", "prob": 50, "level": "High", "recs": ["Heart patients should stay indoors.", "Avoid salty foods to keep BP low.", "Monitor blood pressure regularly."]},
+        {"name": "Allergic Rhinitis", "desc": "High pollution can mimic or worsen severe allergy symptoms.", "prob": 70, "level": "High", "recs": ["Take antihistamines if prescribed.", "Keep windows sealed tight.", "Change clothes immediately after entering."]},
+        {"name": "Eye Irritation", "desc": "Dust and chemicals in the air may cause burning or watery eyes.", "prob": 60, "level": "Moderate", "recs": ["Use lubricating eye drops.", "Wear sunglasses to block dust.", "Avoid rubbing eyes with unwashed hands."]},
+    ),
+    (
+        {"name": "Acute Respiratory Infection", "desc": "Immune system in lungs is compromised, increasing infection risk.", "prob": 80, "level": "Severe", "recs": ["Strictly avoid outdoor exposure.", "Wear N95/N99 masks if transit is necessary.", "Steam inhalation twice a day."]},
+        {"name": "Ischemic Heart Risk", "desc": "Reduced oxygen supply to the heart due to pollution stress.", "prob": 75, "level": "Severe", "recs": ["Elderly should remain strictly indoors.", "Avoid any strenuous physical labor.", "Seek help if experiencing chest heaviness."]},
+        {"name": "Hypoxia Symptoms", "desc": "Lower oxygen intake may lead to headaches and dizziness.", "prob": 60, "level": "High", "recs": ["Use indoor plants or oxygen concentrators.", "Practice shallow, calm breathing.", "Avoid smoking or incense indoors."]},
+        {"name": "Pneumonia Susceptibility", "desc": "Lungs are highly vulnerable to bacterial and viral attacks.", "prob": 50, "level": "High", "recs": ["Maintain strict hand hygiene.", "Stay away from dusty places.", "Consult a doctor for persistent cough."]},
+    ),
+    (
+        {"name": "Severe Lung Impairment", "desc": "Healthy people will experience reduced endurance and breathing difficulty.", "prob": 90, "level": "Critical", "recs": ["Do not go outside under any circumstances.", "Seal window gaps with wet towels.", "Run air purifiers on maximum speed."]},
+        {"name": "Cerebrovascular Risk", "desc": "Increased risk of stroke due to thickened blood and inflammation.", "prob": 60, "level": "High", "recs": ["Stay hydrated to keep blood thin.", "Avoid stress and sudden movements.", "Keep emergency contacts ready."]},
+        {"name": "Systemic Inflammation", "desc": "Pollutants entering blood trigger inflammation throughout the body.", "prob": 85, "level": "Critical", "recs": ["Consume anti-inflammatory foods (turmeric, berries).", "Rest as much as possible.", "Avoid cooking that produces smoke."]},
+        {"name": "Pulmonary Edema Risk", "desc": "Fluid buildup in air sacs due to toxic chemical irritation.", "prob": 40, "level": "Severe", "recs": ["Seek immediate medical care for breathing issues.", "Sleep with head elevated.", "Avoid lying flat if breathing is hard."]},
+    ),
+    (
+        {"name": "Acute Respiratory Distress (ARDS)", "desc": "Life-threatening lung failure potential. Oxygen absorption blocked.", "prob": 95, "level": "Emergency", "recs": ["Evacuate to a cleaner area if possible.", "Use medical-grade oxygen if prescribed.", "Wear N99/P100 respirator if moving."]},
+        {"name": "Cardiac Arrest Risk", "desc": "Extremely high stress on heart muscles due to toxic air.", "prob": 70, "level": "Emergency", "recs": ["Absolute bed rest suggested.", "Keep defibrillator/emergency services on speed dial.", "Do not exert yourself in any way."]},
+        {"name": "Asphyxiation Hazard", "desc": "Air is chemically toxic. Feeling of choking or suffocation.", "prob": 90, "level": "Emergency", "recs": ["Create a 'clean room' with no leaks.", "Use double-filtration air purifiers.", "Limit talking to conserve oxygen."]},
+        {"name": "Permanent Lung Damage", "desc": "Long-term scarring of lung tissue (Fibrosis) possible.", "prob": 80, "level": "Critical", "recs": ["Follow up with a pulmonologist immediately.", "Start long-term lung detox measures.", "Consider relocation if conditions persist."]},
+    ),
+)
+
+HEALTH_JSON = {id(b): app.json.dumps(b) for b in HEALTH_BANDS}
+
+def health_band(aqi): return bisect.bisect_left(HEALTH_UPPER, aqi)
+
+@timed('health')
 def calc_health(val):
     pm25 = val.get('pm25', 0)
     pm10 = val.get('pm10', 0)
-    aqi = calculate_aqi(pm25, pm10)
-
-    if aqi <= 100:
-        return [
-            {"name": "General Well-being", "desc": "Air quality is satisfactory. It is a great day to be active outside.", "prob": 5, "level": "Good", "recs": ["Ventilate your home freely.", "Enjoy outdoor activities.", "No special filtration needed."]},
-            {"name": "Respiratory Health", "desc": "No irritation or respiratory distress expected for the general population.", "prob": 5, "level": "Good", "recs": ["Continue normal exercise routines.", "Deep breathing exercises are safe.", "Enjoy the fresh air."]},
-            {"name": "Sensitive Groups", "desc": "People with asthma or allergies can typically enjoy outdoors.", "prob": 10, "level": "Low", "recs": ["Keep usual rescue inhalers just in case.", "Monitor local pollen levels.", "No masks required."]},
-            {"name": "Skin & Eye Health", "desc": "Clear visibility and low particulate matter mean no irritation.", "prob": 0, "level": "Low", "recs": ["No protective eyewear needed.", "Standard skincare is sufficient.", "Use sunscreen."]}
-        ]
-    elif aqi <= 200:
-        return [
-            {"name": "Mild Respiratory Irritation", "desc": "Sensitive individuals may experience coughing or minor throat irritation.", "prob": 40, "level": "Moderate", "recs": ["Limit prolonged outdoor exertion.", "Hydrate frequently to soothe throat.", "Carry water when walking outside."]},
-            {"name": "Asthma Aggravation", "desc": "Air quality is acceptable for most, but may trigger mild asthma symptoms.", "prob": 50, "level": "Moderate", "recs": ["Keep inhalers accessible at all times.", "Avoid jogging near heavy traffic.", "Watch for wheezing symptoms."]},
-            {"name": "Sinus Pressure", "desc": "Particulates may cause minor nasal congestion or sinus pressure.", "prob": 30, "level": "Moderate", "recs": ["Consider a saline nasal rinse.", "Shower after coming indoors.", "Keep windows closed during peak traffic."]},
-            {"name": "Fatigue Levels", "desc": "Slight reduction in oxygen efficiency may cause quicker tiredness.", "prob": 25, "level": "Low", "recs": ["Take more breaks during exercise.", "Avoid heavy cardio outdoors.", "Monitor heart rate during activity."]}
-        ]
-    elif aqi <= 300:
-        return [
-            {"name": "Bronchitis Risk", "desc": "High PM levels can inflame bronchial tubes causing heavy coughing.", "prob": 65, "level": "High", "recs": ["Avoid all outdoor physical activity.", "Wear an N95 mask if outside.", "Use an air purifier in the bedroom."]},
-            {"name": "Cardiac Stress", "desc": "Fine particles entering the bloodstream can slightly elevate blood pressure.", "prob": 50, "level": "High", "recs": ["Heart patients should stay indoors.", "Avoid salty foods to keep BP low.", "Monitor blood pressure regularly."]},
-            {"name": "Allergic Rhinitis", "desc": "High pollution can mimic or worsen severe allergy symptoms.", "prob": 70, "level": "High", "recs": ["Take antihistamines if prescribed.", "Keep windows sealed tight.", "Change clothes immediately after entering."]},
-            {"name": "Eye Irritation", "desc": "Dust and chemicals in the air may cause burning or watery eyes.", "prob": 60, "level": "Moderate", "recs": ["Use lubricating eye drops.", "Wear sunglasses to block dust.", "Avoid rubbing eyes with unwashed hands."]}
-        ]
-    elif aqi <= 400:
-        return [
-            {"name": "Acute Respiratory Infection", "desc": "Immune system in lungs is compromised, increasing infection risk.", "prob": 80, "level": "Severe", "recs": ["Strictly avoid outdoor exposure.", "Wear N95/N99 masks if transit is necessary.", "Steam inhalation twice a day."]},
-            {"name": "Ischemic Heart Risk", "desc": "Reduced oxygen supply to the heart due to pollution stress.", "prob": 75, "level": "Severe", "recs": ["Elderly should remain strictly indoors.", "Avoid any strenuous physical labor.", "Seek help if experiencing chest heaviness."]},
-            {"name": "Hypoxia Symptoms", "desc": "Lower oxygen intake may lead to headaches and dizziness.", "prob": 60, "level": "High", "recs": ["Use indoor plants or oxygen concentrators.", "Practice shallow, calm breathing.", "Avoid smoking or incense indoors."]},
-            {"name": "Pneumonia Susceptibility", "desc": "Lungs are highly vulnerable to bacterial and viral attacks.", "prob": 50, "level": "High", "recs": ["Maintain strict hand hygiene.", "Stay away from dusty places.", "Consult a doctor for persistent cough."]}
-        ]
-    elif aqi <= 500:
-        return [
-            {"name": "Severe Lung Impairment", "desc": "Healthy people will experience reduced endurance and breathing difficulty.", "prob": 90, "level": "Critical", "recs": ["Do not go outside under any circumstances.", "Seal window gaps with wet towels.", "Run air purifiers on maximum speed."]},
-            {"name": "Cerebrovascular Risk", "desc": "Increased risk of stroke due to thickened blood and inflammation.", "prob": 60, "level": "High", "recs": ["Stay hydrated to keep blood thin.", "Avoid stress and sudden movements.", "Keep emergency contacts ready."]},
-            {"name": "Systemic Inflammation", "desc": "Pollutants entering blood trigger inflammation throughout the body.", "prob": 85, "level": "Critical", "recs": ["Consume anti-inflammatory foods (turmeric, berries).", "Rest as much as possible.", "Avoid cooking that produces smoke."]},
-            {"name": "Pulmonary Edema Risk", "desc": "Fluid buildup in air sacs due to toxic chemical irritation.", "prob": 40, "level": "Severe", "recs": ["Seek immediate medical care for breathing issues.", "Sleep with head elevated.", "Avoid lying flat if breathing is hard."]}
-        ]
-    else:
-        return [
-            {"name": "Acute Respiratory Distress (ARDS)", "desc": "Life-threatening lung failure potential. Oxygen absorption blocked.", "prob": 95, "level": "Emergency", "recs": ["Evacuate to a cleaner area if possible.", "Use medical-grade oxygen if prescribed.", "Wear N99/P100 respirator if moving."]},
-            {"name": "Cardiac Arrest Risk", "desc": "Extremely high stress on heart muscles due to toxic air.", "prob": 70, "level": "Emergency", "recs": ["Absolute bed rest suggested.", "Keep defibrillator/emergency services on speed dial.", "Do not exert yourself in any way."]},
-            {"name": "Asphyxiation Hazard", "desc": "Air is chemically toxic. Feeling of choking or suffocation.", "prob": 90, "level": "Emergency", "recs": ["Create a 'clean room' with no leaks.", "Use double-filtration air purifiers.", "Limit talking to conserve oxygen."]},
-            {"name": "Permanent Lung Damage", "desc": "Long-term scarring of lung tissue (Fibrosis) possible.", "prob": 80, "level": "Critical", "recs": ["Follow up with a pulmonologist immediately.", "Start long-term lung detox measures.", "Consider relocation if conditions persist."]}
-        ]
+    return HEALTH_BANDS[health_band(calculate_aqi(pm25, pm10))]
+
+def shared_band(risks):
+    """Maps decoded health risks back to the HEALTH_BANDS object, so they reuse its pre-encoded JSON"""
+    if not risks: return risks
+    return next((b for b in HEALTH_BANDS if b[0]['name'] == risks[0]['name']), risks)
+
+# --- FLEET (PER-DEVICE STATE) ---
+# Readings that carry a device id also land in that device's own document ('device:<id>' in the state backend)
+# with its own chart ring and rolling means. Workers cache parsed devices by version, so a reading or a
+# ?device= read touches one document however large the fleet is. current_data stays the "latest from any sensor" view.
+DEVICE_PREFIX = 'device:'
+device_cache = LRUCache(int(os.environ.get('SKYSENSE_DEVICE_CACHE', 1024)))
+
+class DeviceState:
+    """One sensor's state document; `published` holds (version, body, summary) as last committed"""
+    SUMMARY_FIELDS = ('aqi', 'pm25', 'pm10', 'lat', 'lon', 'location_name', 'last_seen')
+
+    def __init__(self, device, version=0, text=None):
+        self.device = device
+        self.rolling = RollingMeans()
+        self.data = {"device": device, "aqi": 0, "avg_aqi": 0, "last_seen": None, "location_name": "Waiting for GPS...",
+                     "health_risks": [], "chart_data": ChartBuffer(), "rolling": {}}
+        self.data.update({k: 0 for k in SENSOR_FIELDS})
+        self.data.update({'avg_' + k: 0 for k in RollingMeans.FIELDS})
+        if text:
+            doc = json.loads(text)
+            saved = doc['data']
+            chart = saved.pop('chart_data', {})
+            saved['health_risks'] = shared_band(saved.get('health_risks'))
+            self.data.update(saved)
+            self.data['chart_data'] = ChartBuffer(chart.get('aqi', []), chart.get('gps', []))
+            self.rolling.load(doc.get('rolling'))
+        self.publish(version)
+
+    def apply(self, d, ts):
+        fold_reading(self.data, self.rolling, d, ts)
+        self.data['last_seen'] = ts
+
+    def encode(self):
+        return '{"data":{%s},"rolling":%s}' % (self.body(), self.rolling.encode())
+
+    def body(self): return ','.join(f"{json.dumps(k)}:{encode_field(v)}" for k, v in self.data.items())
+
+    def publish(self, version):
+        summary = {"device": self.device, "version": version, **{k: self.data[k] for k in self.SUMMARY_FIELDS}}
+        self.published = (version, f"{{{self.body()}}}".encode(), json.dumps(summary))
+
+def load_device(device, version=None):
+    """Cached DeviceState for device at its committed version, or None for an unknown device"""
+    key = DEVICE_PREFIX + device
+    if version is None: version = state.version(key)
+    if not version: return None
+    dev = device_cache.get(key)
+    if dev is None or dev.published[0] != version:
+        version, text = state.read(key)
+        if not text: return None
+        dev = DeviceState(device, version, text)
+        device_cache.put(key, dev)
+    return dev
+
+def update_device(device, change):
+    """Runs change(dev) on one device's document in a single transaction; change returning False writes nothing"""
+    key = DEVICE_PREFIX + device
+    try:
+        with state.transaction(key) as tx:
+            dev = device_cache.get(key)
+            if dev is None or dev.published[0] != tx.version: dev = DeviceState(device, tx.version, tx.value)
+            if change(dev) is False: return
+            tx.new = dev.encode()
+        dev.publish(tx.version)
+        device_cache.put(key, dev)
+    except BaseException:
+        device_cache.pop(key)  # the cached copy may be half-updated
+        raise
+
+def apply_device_readings(device, items):
+    """Folds (reading, ts) pairs into one device's document in a single transaction"""
+    def fold(dev):
+        for d, ts in items: dev.apply(d, ts)
+    update_device(device, fold)
+
+def show_device(device):
+    """Points the dashboard at one device: its latest values, its own 24h means and AQI, place and chart,
+    so the headline AQI and the PM values beside it always describe the same sensor"""
+    dev = load_device(device)
+    if dev is None: return
+    with state_txn() as cd:
+        cd.update({k: v for k, v in dev.data.items() if k in cd and k != 'chart_data'})
+        chart = dev.data['chart_data'].to_dict()
+        cd['chart_data'] = ChartBuffer(chart['aqi'], chart['gps'])
+
+def locate_devices(key, name):
+    """Fills name into every device document still showing "Updating..." at geocode key"""
+    def waiting(data): return data['location_name'] == "Updating..." and data['lat'] != 0 and geo_key(data['lat'], data['lon']) == key
+    def fill(dev):
+        if not waiting(dev.data): return False
+        dev.data['location_name'] = name
+    for dkey, version in state.scan(DEVICE_PREFIX):
+        dev = load_device(dkey[len(DEVICE_PREFIX):], version)
+        if dev is not None and waiting(dev.data): update_device(dev.device, fill)
+
+def apply_fleet_readings(readings, rows):
+    """Routes readings that name a device to their device documents, one transaction per device"""
+    by_device = {}
+    for d, row in zip(readings, rows):
+        if row[1] is not None: by_device.setdefault(row[1], []).append((d, row[0]))
+    for device, items in by_device.items(): apply_device_readings(device, items)
+
+# --- UPLOAD JOBS ---
+# Parsing and aggregation run in a process pool; the request only stores the file and returns a job id.
+# Job status lives in the store, so /api/jobs/<id> answers from any worker. 0 workers = run inline.
+UPLOAD_WORKERS = int(os.environ.get('SKYSENSE_UPLOAD_WORKERS', os.cpu_count() or 1))
+upload_pool = {}  # pid -> executor, so a forked worker never reuses its parent's pool
+upload_pool_lock = threading.Lock()
+
+def get_upload_pool(broken=None):
+    """This process's upload pool; passing the current pool as broken replaces it (a child died, e.g. OOM-killed)"""
+    with upload_pool_lock:
+        pool = upload_pool.get(os.getpid())
+        if pool is not None and pool is broken:
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = None
+        if pool is None:
+            pool = upload_pool[os.getpid()] = ProcessPoolExecutor(UPLOAD_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return pool
+
+def run_upload_job(job_id, digest):
+    """Pool side: parse the stored object (or replay its sidecar) and return the flight summary"""
+    store.update_job(job_id, status='running')
+    t = time.perf_counter()
+    fl = ingest_file(object_path(digest), progress=lambda rows: store.update_job(job_id, rows=rows), digest=digest)
+    fl['seconds'] = time.perf_counter() - t  # reported back, since pool processes don't serve /metrics
+    return fl
+
+def name_track(gps):
+    """Labels each chart point with its gazetteer place, when one is loaded and within range"""
+    if not gazetteer: return
+    for g, name in zip(gps, gazetteer.nearest_batch([g['lat'] for g in gps], [g['lon'] for g in gps])):
+        if name: g['name'] = name
+
+def apply_flight(fl, digest, filename, dt):
+    name_track(fl['chart_gps'])
+    pm1, pm25, pm10, temp, hum, aqi = fl['pm1'], fl['pm25'], fl['pm10'], fl['temp'], fl['hum'], fl['aqi']
+    store.add_upload(dt, filename, aqi, pm25, pm10, sha256=digest)
+    with state_txn(touch=('history',)) as cd:
+        cd.update({
+            "aqi": aqi, "location_name": resolve_location(fl['lat'], fl['lon']), 
+            "lat": fl['lat'], "lon": fl['lon'], "device": None,
+            "pm1": pm1, "pm25": pm25, "pm10": pm10, "temp": temp, "hum": hum,
+            "avg_pm1": pm1, "avg_pm25": pm25, "avg_pm10": pm10, 
+            "health_risks": calc_health({"pm25": pm25, "pm10": pm10}), 
+        })
+        cd['chart_data'].reset(fl['chart_aqi'], fl['chart_gps'])
+        return {k: cd[k] for k in ('aqi', 'pm1', 'pm25', 'pm10', 'temp', 'hum', 'lat', 'lon', 'location_name')}
+
+def complete_upload_job(job_id, digest, filename, dt, fl):
+    metrics.inc("skysense_rows_ingested_total", fl['rows'])
+    metrics.observe("skysense_section_duration_seconds", fl['seconds'], section='parse')
+    store.update_job(job_id, status='done', rows=fl['rows'], result=apply_flight(fl, digest, filename, dt))
+
+def finish_upload_job(job_id, digest, filename, dt, fut, pool):
+    try: fl = fut.result()
+    except BrokenProcessPool:
+        get_upload_pool(broken=pool)  # so the next upload gets working processes
+        return store.update_job(job_id, status='error', error="Upload worker process died")
+    except Exception as e: return store.update_job(job_id, status='error', error=str(e))
+    try: complete_upload_job(job_id, digest, filename, dt, fl)
+    except Exception as e: store.update_job(job_id, status='error', error=str(e))
+
+def submit_upload_job(job_id, digest, filename, dt):
+    if UPLOAD_WORKERS <= 0:
+        try: fl = run_upload_job(job_id, digest)
+        except Exception as e: return store.update_job(job_id, status='error', error=str(e))
+        return complete_upload_job(job_id, digest, filename, dt, fl)
+    pool = get_upload_pool()
+    try:
+        try: fut = pool.submit(run_upload_job, job_id, digest)
+        except BrokenProcessPool:  # broke since the last upload: retry once on a fresh pool
+            pool = get_upload_pool(broken=pool)
+            fut = pool.submit(run_upload_job, job_id, digest)
+    except Exception as e: return store.update_job(job_id, status='error', error=str(e))
+    fut.add_done_callback(lambda f: finish_upload_job(job_id, digest, filename, dt, f, pool))
+
+# --- EXPORTS ---
+# /export/<fmt> streams stored rows (a date range of live readings, or one uploaded flight) frame by frame,
+# with per-row AQI and health band. Finished files are kept in uploads/exports, keyed by content digest
+# (flights) or by state version and last reading id (ranges), so repeated downloads are served from disk.
+EXPORT_DIR = os.path.join(UPLOAD_FOLDER, 'exports')
+os.makedirs(EXPORT_DIR, exist_ok=True)
+EXPORT_CACHE_FILES = int(os.environ.get('SKYSENSE_EXPORT_CACHE', 64))
+EXPORT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson', 'parquet': 'application/vnd.apache.parquet'}
+HEALTH_LEVELS = np.array([b[0]['level'] for b in HEALTH_BANDS], dtype=object)
+
+def with_health(df):
+    """Adds aqi (when missing) and health_band columns to a frame of readings"""
+    if 'aqi' not in df.columns:
+        zeros = np.zeros(len(df))
+        df['aqi'] = calculate_aqi_array(df['pm25'] if 'pm25' in df.columns else zeros, df['pm10'] if 'pm10' in df.columns else zeros)
+    aqi = pd.to_numeric(df['aqi'], errors='coerce').fillna(0).to_numpy(float)
+    df['health_band'] = HEALTH_LEVELS[np.searchsorted(HEALTH_UPPER, aqi, side='left')]
+    return df
+
+def reading_export_frames(start, end, device):
+    for df in store.reading_frames(start, end, device, CHUNK_ROWS):
+        df.insert(0, 'time', pd.to_datetime(df.pop('ts'), unit='s', utc=True).dt.floor('ms'))
+        # Fixed dtypes per column, so every chunk (even an all-null one) maps to the same Parquet schema
+        df['device'] = df['device'].astype('string')
+        for c in SENSOR_FIELDS: df[c] = pd.to_numeric(df[c], errors='coerce').astype(float)
+        yield with_health(df)
+
+def flight_export_frames(digest):
+    frames = iter_parsed(digest) if has_parsed(digest) else write_parsed(digest, parse_frames(object_path(digest)))
+    for df in frames:
+        df.insert(0, 'row', df.index)
+        yield with_health(df)
+
+def text_chunks(frames, fmt):
+    header = True
+    for df in frames:
+        if fmt == 'csv': yield df.to_csv(index=False, header=header).encode()
+        elif len(df): yield df.to_json(orient='records', lines=True, date_format='iso').rstrip('\n').encode() + b'\n'
+        header = False
+
+def publish_export(tmp, path):
+    os.replace(tmp, path)
+    cached = sorted((e for e in os.scandir(EXPORT_DIR) if not e.name.startswith('tmp')), key=lambda e: e.stat().st_mtime)
+    for e in cached[:-EXPORT_CACHE_FILES]:
+        try: os.remove(e.path)
+        except OSError: pass
+
+def cached_chunks(chunks, path):
+    """Passes chunks through to the client while writing them to the export cache"""
+    fd, tmp = tempfile.mkstemp(dir=EXPORT_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in chunks:
+                out.write(chunk)
+                yield chunk
+        publish_export(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def write_parquet(frames, path):
+    """Parquet needs its footer last, so it is written out (one row group per frame) before sending"""
+    fd, tmp = tempfile.mkstemp(dir=EXPORT_DIR)
+    os.close(fd)
+    writer = None
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None: writer = pq.ParquetWriter(tmp, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if writer: writer.close()
+        publish_export(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def export_response(fmt, key, frames, download_name):
+    path = os.path.join(EXPORT_DIR, hashlib.sha1(key.encode()).hexdigest() + '.' + fmt)
+    if not os.path.exists(path) and fmt == 'parquet': write_parquet(frames(), path)
+    if os.path.exists(path): return send_file(path, mimetype=EXPORT_TYPES[fmt], as_attachment=True, download_name=download_name)
+    resp = Response(cached_chunks(text_chunks(frames(), fmt), path), mimetype=EXPORT_TYPES[fmt])
+    resp.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    return resp
+
+def day_start(value, default):
+    """Epoch seconds at local midnight of a YYYY-MM-DD argument"""
+    if not value: return default
+    return time.mktime(datetime.date.fromisoformat(value).timetuple())
 
 # --- FRONTEND TEMPLATE ---
 HTML_TEMPLATE = """
@@ -276,11 +1651,11 @@ body{font-family:'Inter',sans-serif;background:var(--bg);color:var(--text);paddi
   </div>
  </div>
 
- <div id="exp" class="section"><div class="card"><h3>Export</h3><p>Download a comprehensive report including location, averages, PM levels, and detailed health precautions.</p><a href="/export/text" style="display:inline-block;padding:12px 25px;background:#0f172a;color:#fff;text-decoration:none;border-radius:8px;margin-top:10px;"><i class="fa-solid fa-file-export"></i> Download Report</a></div></div>
+ <div id="exp" class="section"><div class="card"><h3>Export</h3><p>Download a comprehensive report including location, averages, PM levels, and detailed health precautions.</p><a href="/export/text" style="display:inline-block;padding:12px 25px;background:#0f172a;color:#fff;text-decoration:none;border-radius:8px;margin-top:10px;"><i class="fa-solid fa-file-export"></i> Download Report</a> <a href="/export/csv" style="display:inline-block;padding:12px 25px;background:#2563eb;color:#fff;text-decoration:none;border-radius:8px;margin-top:10px;"><i class="fa-solid fa-table"></i> Readings CSV</a></div></div>
 
 </div>
 <script>
- let cGps=null, cTr=null, hist=[], locCache={};
+ let cGps=null, cTr=null, st={}, ver=0;
  function sw(id){ 
    document.querySelectorAll('.section').forEach(x=>x.classList.remove('active')); 
    document.getElementById(id).classList.add('active'); 
@@ -291,43 +1666,40 @@ body{font-family:'Inter',sans-serif;background:var(--bg);color:var(--text);paddi
    if(id==='anl') upTr(); 
  }
  document.getElementById('dt').valueAsDate=new Date();
- setInterval(()=>{ fetch('/api/data').then(r=>r.json()).then(d=>{ hist=d.historical_stats||[]; upUI(d); }); },3000);
+ // Server push when available, otherwise 3s delta polling (304 when nothing changed)
+ function onDelta(d){ Object.assign(st,d.changes); ver=d.version; upUI(st); }
+ function poll(){ fetch('/api/data?since='+ver).then(r=>{ if(r.status===200) r.json().then(onDelta); }).catch(()=>{}); }
+ let pollT=null; function startPoll(){ if(!pollT){ poll(); pollT=setInterval(poll,3000); } }
+ // A refused stream (204) or a dead one closes for good: poll instead. While EventSource retries, catch up once.
+ if(window.EventSource){ let es=new EventSource('/api/stream'); es.onmessage=e=>onDelta(JSON.parse(e.data)); es.onerror=()=>{ if(es.readyState===2) startPoll(); else poll(); }; }
+ else startPoll();
  document.getElementById('fIn').addEventListener('change',async(e)=>{
   let f=e.target.files[0]; if(!f)return;
   let txt=document.getElementById('upload-text'); txt.innerText="Uploading...";
   let fd=new FormData(); fd.append('file',f); fd.append('date',document.getElementById('dt').value);
-  try{ const res=await fetch('/upload',{method:'POST',body:fd}); const d=await res.json(); 
+  try{ const res=await fetch('/upload',{method:'POST',body:fd}); let d=await res.json(); 
+       let tries=0, busy=()=>!d.error && (d.status==='queued'||d.status==='running');
+       while(busy() && tries++<600){
+        txt.innerText=`Processing... ${d.rows||0} rows`; await new Promise(r=>setTimeout(r,1000));
+        d=await (await fetch('/api/jobs/'+d.job_id)).json();
+       }
+       if(busy()){ txt.innerText="Still processing, check the upload log later"; return; }
        txt.innerText=d.error?"Upload Failed":"Upload Success!"; 
-       if(!d.error){ upUI(d.data); setTimeout(()=>sw('ov'),800); }
+       if(!d.error){ fetch('/api/data').then(r=>r.json()).then(upUI); setTimeout(()=>sw('ov'),800); }
   }catch(e){ txt.innerText="Error"; }
  });
  function upTr(){
-  let d=parseInt(document.getElementById('trendFilter').value);
-  let ctx=document.getElementById('chartTr').getContext('2d'); if(cTr)cTr.destroy();
-  let cut=new Date(); cut.setDate(cut.getDate()-d);
-  let f=hist.filter(x=>new Date(x.date)>=cut).sort((a,b)=>new Date(a.date)-new Date(b.date));
-  cTr=new Chart(ctx,{type:'line',data:{labels:f.map(x=>x.date),datasets:[{label:'Average AQI',data:f.map(x=>x.aqi),borderColor:'#0f172a',backgroundColor:'rgba(15,23,42,0.1)',fill:true,tension:0.3}]},options:{responsive:true,maintainAspectRatio:false}});
- }
- async function resolveLoc(lat, lon) {
-    if(lat===0) return "Waiting...";
-    let key = `${lat.toFixed(3)},${lon.toFixed(3)}`;
-    if(locCache[key]) return locCache[key];
-    try {
-        let res = await fetch(`https://nominatim.openstreetmap.org/reverse?format=json&lat=${lat}&lon=${lon}`);
-        let data = await res.json();
-        let add = data.address;
-        let name = add.neighbourhood || add.suburb || add.road || add.city || add.town;
-        let city = add.city || add.town || add.county || add.state;
-        let loc = name && city ? `${name}, ${city}` : (name || city || `${lat.toFixed(3)}, ${lon.toFixed(3)}`);
-        locCache[key] = loc;
-        return loc;
-    } catch(e) { return `${lat.toFixed(3)}, ${lon.toFixed(3)}`; }
+  let d=document.getElementById('trendFilter').value;
+  fetch('/api/trends?days='+d).then(r=>r.json()).then(t=>{
+   let ctx=document.getElementById('chartTr').getContext('2d'); if(cTr)cTr.destroy();
+   cTr=new Chart(ctx,{type:'line',data:{labels:t.points.map(x=>x.date),datasets:[{label:'Average AQI',data:t.points.map(x=>x.aqi),borderColor:'#0f172a',backgroundColor:'rgba(15,23,42,0.1)',fill:true,tension:0.3}]},options:{responsive:true,maintainAspectRatio:false}});
+  });
  }
  async function upUI(d){
   document.getElementById('aqi').innerText=d.aqi; 
   
-  // FRONTEND GEOCODING FIX
-  let locTxt = await resolveLoc(d.lat, d.lon);
+  // Place names are resolved by the backend geocoding worker
+  let locTxt = d.location_name==='Updating...' ? `${Number(d.lat).toFixed(3)}, ${Number(d.lon).toFixed(3)}` : d.location_name;
   document.getElementById('loc').innerText = locTxt;
   
   document.getElementById('p1').innerText=d.pm1; document.getElementById('p2').innerText=d.pm25; document.getElementById('p10').innerText=d.pm10;
@@ -342,12 +1714,12 @@ body{font-family:'Inter',sans-serif;background:var(--bg);color:var(--text);paddi
    });
   }
   let tb=document.getElementById('tb-hist');
-  if(d.history.length) tb.innerHTML=d.history.map(x=>`<tr><td>${x.date}</td><td><a href="/uploads/${x.filename}" target="_blank" style="color:#2563eb">${x.filename}</a></td><td>${x.aqi}</td></tr>`).join('');
+  if(d.history.length) tb.innerHTML=d.history.map(x=>`<tr><td>${x.date}</td><td><a href="/uploads/${encodeURIComponent(x.filename)}${x.sha256?'?sha='+x.sha256:''}" target="_blank" style="color:#2563eb">${x.filename}</a></td><td>${x.aqi}</td></tr>`).join('');
   
   if(d.chart_data.aqi.length){
    let ctx=document.getElementById('chartGps').getContext('2d');
    let cleanLoc = locTxt.split(',')[0]; 
-   let labs=d.chart_data.gps.map(g=>`${cleanLoc} (${Number(g.lat).toFixed(3)}, ${Number(g.lon).toFixed(3)})`);
+   let labs=d.chart_data.gps.map(g=>`${g.name?g.name.split(',')[0]:cleanLoc} (${Number(g.lat).toFixed(3)}, ${Number(g.lon).toFixed(3)})`);
    if(cGps)cGps.destroy();
    cGps=new Chart(ctx,{type:'bar',data:{labels:labs,datasets:[{label:'AQI Level',data:d.chart_data.aqi,backgroundColor:'#3b82f6',borderRadius:4}]},options:{indexAxis:'y',responsive:true,maintainAspectRatio:false,scales:{x:{beginAtZero:true}}}});
   }
@@ -357,96 +1729,217 @@ body{font-family:'Inter',sans-serif;background:var(--bg);color:var(--text);paddi
 """
 
 # --- BACKEND ROUTES ---
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    if PROFILE_TOKEN and request.endpoint != 'debug_profile' and profile_authorized(request.args.get('profile') or request.headers.get('X-Profile')):
+        g.sampler = Sampler({threading.get_ident()}).start()
+
+@app.after_request
+def record_request(resp):
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        sampler.stop()
+        if not resp.is_streamed and sampler.samples:  # a request shorter than one interval keeps its body
+            resp = Response(sampler.collapsed(), mimetype='text/plain')
+        resp.headers['X-Profile-Samples'] = str(sampler.samples)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if 'started' in g: metrics.observe("skysense_http_request_duration_seconds", time.perf_counter() - g.started, route=route, method=request.method)
+    metrics.inc("skysense_http_responses_total", route=route, status=resp.status_code)
+    metrics.flush()
+    return resp
+
+@app.route('/metrics')
+def prometheus_metrics():
+    metrics.flush(force=True)
+    snaps = [snap if updated > time.time() - 60 else {**snap, "gauges": []} for _, updated, snap in store.all_metrics()]  # stale workers' gauges
+    return Response(render_metrics(snaps), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    # POST ?seconds=N starts sampling every thread of this worker; GET returns the running or last window
+    global profile_window
+    if not profile_authorized(request.args.get('token') or request.headers.get('X-Profile')): return jsonify({"error": "Not found"}), 404
+    if request.method == 'POST':
+        if profile_window is not None and profile_window.running: return jsonify({"error": "Profile already running"}), 409
+        seconds = max(0.1, min(request.args.get('seconds', 30, type=float), PROFILE_MAX_SECONDS))  # 0 would mean no deadline
+        profile_window = Sampler().start(seconds)
+        return jsonify({"status": "started", "seconds": seconds, "pid": os.getpid()}), 202
+    if profile_window is None: return jsonify({"error": "No profile yet"}), 404
+    if request.args.get('stop'): profile_window.stop()
+    resp = Response(profile_window.collapsed(), mimetype='text/plain')
+    resp.headers.update({'X-Profile-Samples': str(profile_window.samples), 'X-Profile-Running': str(profile_window.running).lower(), 'X-Profile-Pid': str(os.getpid())})
+    return resp
+
 @app.route('/')
 def home(): return render_template_string(HTML_TEMPLATE)
 
 @app.route('/api/data')
 def get_data(): 
-    current_data['history'] = history_log
-    current_data['historical_stats'] = historical_stats
-    return jsonify(current_data)
+    since = request.args.get('since', type=int)
+    if request.args.get('device') is not None: return device_data(request.args['device'], since)
+    gz = 'gzip' in request.headers.get('Accept-Encoding', '')
+    with state_lock:
+        sync_state()
+        v = state_version
+        if since == v: return '', 304
+        body = response_cache.get(v, (since, False), lambda: encode_payload(since))
+        if gz and len(body) >= GZIP_MIN_BYTES: body = response_cache.get(v, (since, True), lambda: gzip.compress(body, 6))
+        else: gz = False
+    resp = Response(body, mimetype='application/json')
+    if gz: resp.headers['Content-Encoding'] = 'gzip'
+    resp.vary.add('Accept-Encoding')
+    resp.set_etag(f"{v}-gz" if gz else str(v))  # distinct validators for the two encodings of one version
+    return resp.make_conditional(request)
+
+def device_data(device, since=None):
+    dev = load_device(device)
+    if dev is None: return jsonify({"error": "Unknown device"}), 404
+    v, body, _ = dev.published
+    if since == v: return '', 304
+    resp = Response(body, mimetype='application/json')
+    resp.set_etag(str(v))
+    return resp.make_conditional(request)
+
+@app.route('/api/fleet')
+def fleet():
+    """One compact summary per device; only devices whose version moved are re-read"""
+    devices, index = [], state.scan(DEVICE_PREFIX)
+    for key, v in index:
+        dev = load_device(key[len(DEVICE_PREFIX):], v)
+        if dev is not None: devices.append(dev.published)
+    etag = hashlib.sha1(repr(index).encode()).hexdigest()
+    resp = Response(f'{{"count":{len(devices)},"devices":[{",".join(p[2] for p in devices)}]}}', mimetype='application/json')
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+@app.route('/api/stream')
+def stream():
+    # Server-Sent Events: each message is an encode_payload delta; reconnecting clients resume from Last-Event-ID.
+    # Commits on this worker wake the stream at once, other workers' commits within SSE_POLL seconds.
+    # Each stream pins a worker thread, so at most SSE_MAX are open per worker and each lasts SSE_LIFETIME;
+    # over the cap the client gets 204, which makes EventSource give up and the page fall back to polling.
+    if not sse_slots.acquire(blocking=False): return Response(status=204)
+    since = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', 0, type=int)
+    def events(v):
+        idle, deadline = 0, time.monotonic() + SSE_LIFETIME
+        yield b"retry: 3000\n\n"
+        while time.monotonic() < deadline:
+            with state_lock:
+                sync_state()
+                cur = state_version
+                msg = response_cache.get(cur, (v, False), lambda: encode_payload(v)) if cur != v else None
+            if msg:
+                v, idle = cur, 0
+                yield b"id: %d\ndata: %s\n\n" % (v, msg)
+                continue
+            with state_changed: state_changed.wait(SSE_POLL)
+            idle += 1
+            if idle % 15 == 0: yield b": keepalive\n\n"
+    resp = Response(events(since), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(sse_slots.release)
+    return resp
+
+@app.route('/api/trends')
+def trends():
+    # Served from the incrementally maintained rollups: at most TREND_POINTS points whatever the window
+    days = min(max(1, request.args.get('days', 7, type=int)), TREND_MAX_DAYS)
+    period = 'day' if days <= 31 else 'week' if days <= 180 else 'month'
+    cut = datetime.date.today() - datetime.timedelta(days=days)
+    start = {'day': cut, 'week': cut - datetime.timedelta(days=cut.weekday()), 'month': cut.replace(day=1)}[period]
+    rows = store.rollups(period, start.isoformat())
+    step = -(-len(rows) // TREND_POINTS) or 1
+    points = []
+    for i in range(0, len(rows), step):
+        grp = rows[i:i+step]
+        pt = {"date": grp[0]['bucket'], "n": sum(r['n'] for r in grp)}
+        for f in Store.ROLLUP_FIELDS:
+            have = [r for r in grp if r[f + '_n']]
+            n = sum(r[f + '_n'] for r in have)
+            pt[f] = round(sum(r[f + '_sum'] for r in have) / n, 1) if n else None
+            pt[f + '_min'] = min((r[f + '_min'] for r in have), default=None)
+            pt[f + '_max'] = max((r[f + '_max'] for r in have), default=None)
+        points.append(pt)
+    return jsonify({"days": days, "period": period, "points": points})
 
 @app.route('/uploads/<filename>')
-def dl(filename): return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+def dl(filename):
+    # ?sha=<digest> (upload log links) pins the exact upload; a bare name gets the latest file uploaded under it
+    sha = request.args.get('sha')
+    if sha is not None:
+        found = store.upload_file(sha)
+        if found is None: return jsonify({"error": "Unknown upload"}), 404
+        return send_file(object_path(found[1]), download_name=filename)
+    digest = store.file_digest(filename)
+    if digest is None: return send_from_directory(app.config['UPLOAD_FOLDER'], filename)  # saved before the object store
+    return send_file(object_path(digest), download_name=filename)
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    global current_data
     if 'file' not in request.files: return jsonify({"error": "No file"}), 400
     f, dt = request.files['file'], request.form.get('date', str(datetime.date.today()))
     try:
-        f.save(os.path.join(app.config['UPLOAD_FOLDER'], f.filename))
-        f.seek(0)
-        df = normalize_columns(read_file_safely(f))
-        
-        # NOTE: Removed .head(100) to calculate AQI from the full file
-        valid = [r for i, r in df.iterrows() if r.get('lat',0) != 0]
-        if not valid: raise ValueError("No GPS Data")
-        
-        # Calculate stats from ALL valid rows to match the true average
-        df_valid = pd.DataFrame(valid)
-        pm1 = round(df_valid['pm1'].mean(), 1) if 'pm1' in df_valid.columns else 0
-        pm25 = round(df_valid['pm25'].mean(), 1) if 'pm25' in df_valid.columns else 0
-        pm10 = round(df_valid['pm10'].mean(), 1) if 'pm10' in df_valid.columns else 0
-        temp = round(df_valid['temp'].mean(), 1) if 'temp' in df_valid.columns else 0
-        hum = round(df_valid['hum'].mean(), 1) if 'hum' in df_valid.columns else 0
-        
-        # Use proper Indian Standard AQI Formula
-        aqi = calculate_aqi(pm25, pm10)
-        
-        # NOTE: Backend location disabled to rely on frontend (prevents blocks)
-        loc = "Updating..." 
-        
-        history_log.insert(0, {"date":dt, "filename":f.filename, "status":"Success", "aqi": aqi})
-        existing = next((x for x in historical_stats if x['date'] == dt), None)
-        if existing: existing['aqi'] = aqi
-        else: historical_stats.append({"date": dt, "aqi": aqi})
-        historical_stats.sort(key=lambda x: x['date'])
-        
-        # Filter logic is ONLY for the chart points to avoid clutter
-        filtered_for_chart = [valid[0]]
-        for r in valid[1:]:
-            if has_moved(r['lat'], r['lon']): filtered_for_chart.append(r)
-
-        # Save data
-        current_data.update({
-            "aqi": aqi, "location_name": loc, 
-            "lat": valid[0]['lat'], "lon": valid[0]['lon'],
-            "pm1": pm1, "pm25": pm25, "pm10": pm10, "temp": temp, "hum": hum,
-            "avg_pm1": pm1, "avg_pm25": pm25, "avg_pm10": pm10, 
-            "health_risks": calc_health({"pm25": pm25, "pm10": pm10}), 
-            "chart_data": {
-                # Calculate individual AQI for each chart point using the correct formula
-                "aqi": [calculate_aqi(r['pm25'], r['pm10']) for r in filtered_for_chart], 
-                "gps": [{"lat":r['lat'], "lon":r['lon']} for r in filtered_for_chart]
-            }
-        })
-        return jsonify({"message": "OK", "data": current_data})
+        digest, size = save_object(f.stream)
+        metrics.inc("skysense_upload_bytes_total", size)
+        store.put_file(f.filename, digest, size)
+        job_id = uuid.uuid4().hex
+        store.create_job(job_id, f.filename, dt, digest)
+        submit_upload_job(job_id, digest, f.filename, dt)
+        job = store.get_job(job_id)
+        return jsonify(job), {'done': 200, 'error': 500}.get(job['status'], 202)
     except Exception as e: return jsonify({"error": str(e)}), 500
 
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = store.get_job(job_id)
+    if job is None: return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
 @app.route('/api/upload_sensor', methods=['POST'])
 def sensor():
+    d = request.get_json(silent=True)
+    if not isinstance(d, dict): return jsonify({"error": "Reading must be a JSON object"}), 400
+    try: ts = reading_time(d)
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    return commit_readings([d], [ts], lambda n: {"status": "ok"})
+
+@app.route('/api/upload_sensor/batch', methods=['POST'])
+def sensor_batch():
+    # Accepts a JSON array or an NDJSON body (Content-Type: application/x-ndjson), so a
+    # device can flush its offline buffer in one request, chunked over a single connection
+    # Parsed before taking the state lock so a slow client never holds it. Nothing is applied unless the
+    # whole body parses, so a device can resend its buffer after a 400 without duplicating readings.
+    readings, times = [], []
+    try:
+        for d in iter_readings(request):
+            if not isinstance(d, dict): raise ValueError("Reading must be a JSON object")
+            times.append(reading_time(d))
+            readings.append(d)
+    except Exception as e: return jsonify({"error": str(e), "index": len(readings), "count": 0}), 400
+    if not readings: return jsonify({"status": "ok", "count": 0})
+    return commit_readings(readings, times, lambda n: {"status": "ok", "count": n})
+
+def commit_readings(readings, times, ok_body):
+    """Applies readings to shared state in one transaction, then to device documents and the store.
+    A failure before the commit changes nothing (400, count 0); after it, the readings count as accepted (500)."""
     try:
-        d = request.json
-        # Use proper AQI Formula for live sensor data
-        aqi = calculate_aqi(d.get('pm25',0), d.get('pm10',0))
-        
-        current_data.update(d)
-        current_data['aqi'] = aqi
-        current_data['health_risks'] = calc_health(current_data)
-        
-        if has_moved(d.get('lat',0), d.get('lon',0)) and d.get('lat',0) != 0:
-            current_data['chart_data']['aqi'].append(aqi)
-            current_data['chart_data']['gps'].append({"lat":d.get('lat',0),"lon":d.get('lon',0)})
-            if len(current_data['chart_data']['aqi']) > 50: 
-                current_data['chart_data']['aqi'].pop(0); current_data['chart_data']['gps'].pop(0)
-        return jsonify({"status":"ok"})
-    except Exception as e: return jsonify({"error":str(e)}), 400
+        with state_txn() if any(d.get('device') is None for d in readings) else nullcontext():
+            rows = [apply_reading(d, ts) for d, ts in zip(readings, times)]
+    except Exception as e: return jsonify({"error": str(e), "count": 0}), 400
+    metrics.count_readings(len(rows))
+    try:
+        apply_fleet_readings(readings, rows)
+        if rows[-1][1] is not None: show_device(rows[-1][1])
+        store.add_readings(rows)
+    except Exception as e: return jsonify({"error": f"Readings applied to live state but not fully stored: {e}", "count": len(rows)}), 500
+    return jsonify(ok_body(len(rows)))
 
 @app.route('/export/text')
 def export():
-    d = current_data
-    report = f"""==================================================
+    with state_lock:
+        sync_state()
+        d = dict(current_data)
+    parts = [f"""==================================================
 SKYSENSE DETAILED AIR QUALITY REPORT
 ==================================================
 Date: {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
@@ -462,12 +1955,34 @@ Temp   : {d['temp']} °C
 Humidity: {d['hum']} %
 
 2. HEALTH RISKS & PRECAUTIONS
------------------------------"""
+-----------------------------"""]
     for r in d['health_risks']:
-        report += f"\n\n[RISK] {r['name']} ({r['level']})\nDescription: {r['desc']}\nPrecautions:\n"
-        for rec in r['recs']: report += f" - {rec}\n"
-    report += "\n==================================================\nGenerated by SkySense System\n"
-    return send_file(io.BytesIO(report.encode('utf-8')), mimetype='text/plain', as_attachment=True, download_name="SkySense_Report.txt")
+        parts.append(f"\n\n[RISK] {r['name']} ({r['level']})\nDescription: {r['desc']}\nPrecautions:\n")
+        parts.extend(f" - {rec}\n" for rec in r['recs'])
+    parts.append("\n==================================================\nGenerated by SkySense System\n")
+    return send_file(io.BytesIO(''.join(parts).encode('utf-8')), mimetype='text/plain', as_attachment=True, download_name="SkySense_Report.txt")
+
+@app.route('/export/<fmt>')
+def export_data(fmt):
+    # ?flight=<upload id or sha256> (a bare filename means its latest upload),
+    # or a range of live readings: ?start=&end= (YYYY-MM-DD, inclusive) [&device=]
+    if fmt not in EXPORT_TYPES: return jsonify({"error": "Unknown export format"}), 404
+    if fmt == 'parquet' and pq is None: return jsonify({"error": "Parquet export needs pyarrow"}), 501
+    flight = request.args.get('flight')
+    if flight is not None:
+        name, digest = store.upload_file(flight) or (flight, store.file_digest(flight))
+        if digest is None: return jsonify({"error": "Unknown flight"}), 404
+        return export_response(fmt, f"flight:{digest}:{fmt}", lambda: flight_export_frames(digest), f"{os.path.splitext(name)[0]}.{fmt}")
+    try:
+        start = day_start(request.args.get('start'), 0)
+        end = day_start(request.args.get('end'), float('inf') - 1) + 86400
+    except ValueError: return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+    device = request.args.get('device')
+    with state_lock:
+        sync_state()
+        v = state_version
+    key = f"readings:{v}:{store.last_reading_id()}:{start}:{end}:{device}:{fmt}"
+    return export_response(fmt, key, lambda: reading_export_frames(start, end, device), f"SkySense_Readings.{fmt}")
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,69 @@
+"""Synthetic SkySense workloads: drone flight logs (CSV/XLSX) and ESP32 reading streams.
+
+    python bench/generate.py flight 50000 flight.csv
+    python bench/generate.py flight 20000 flight.xlsx
+    python bench/generate.py readings 1000 readings.ndjson --devices 8
+"""
+import argparse
+import io
+import json
+
+import numpy as np
+import pandas as pd
+
+BASE = (17.385, 78.4867)  # Hyderabad
+FLIGHT_COLUMNS = ['Time', 'Latitude', 'Longitude', 'PM1.0 (ug/m3)', 'PM2.5 (ug/m3)', 'PM10 (ug/m3)', 'Temperature (C)', 'Humidity (%)']
+
+def pm_series(rng, n, base=60.0):
+    """Slow drift plus sensor noise and occasional smoke plumes, like a low-cost PM sensor"""
+    drift = base + np.cumsum(rng.normal(0, 0.3, n))
+    plumes = np.convolve(rng.random(n) < 0.002, np.hanning(60) * 250, mode='same')[:n]  # 'same' pads to the kernel for n < 60
+    pm25 = np.clip(drift + plumes + rng.normal(0, 4, n), 1, 900)
+    return pm25 * rng.uniform(0.55, 0.75), pm25, pm25 * rng.uniform(1.3, 1.8) + rng.normal(0, 3, n)
+
+def flight_frame(rows, seed=0, gps_dropout=0.01):
+    """One flight at ~1 Hz: a survey walk with hover segments and GPS dropouts logged as 0,0"""
+    rng = np.random.default_rng(seed)
+    step = rng.normal(0, 2e-5, (rows, 2)) * (rng.random((rows, 1)) > 0.2)  # hovering ~20% of the time
+    lat, lon = BASE[0] + np.cumsum(step[:, 0]), BASE[1] + np.cumsum(step[:, 1])
+    lost = rng.random(rows) < gps_dropout
+    lat[lost], lon[lost] = 0, 0
+    pm1, pm25, pm10 = pm_series(rng, rows)
+    t0 = pd.Timestamp('2026-01-01 06:00:00')
+    return pd.DataFrame(dict(zip(FLIGHT_COLUMNS, [
+        (t0 + pd.to_timedelta(np.arange(rows), unit='s')).strftime('%H:%M:%S'), lat.round(6), lon.round(6),
+        pm1.round(1), pm25.round(1), pm10.round(1), (28 + rng.normal(0, 0.5, rows)).round(1), (55 + rng.normal(0, 2, rows)).round(1),
+    ])))
+
+def flight_bytes(rows, fmt='csv', seed=0):
+    df = flight_frame(rows, seed)
+    if fmt == 'csv': return df.to_csv(index=False).encode()
+    buf = io.BytesIO()
+    df.to_excel(buf, index=False)
+    return buf.getvalue()
+
+def readings(n, devices=1, seed=0):
+    """ESP32 POST bodies for /api/upload_sensor, round-robin over `devices` sensors"""
+    rng = np.random.default_rng(seed)
+    pm1, pm25, pm10 = pm_series(rng, n)
+    out = []
+    for i in range(n):
+        d = {"pm1": round(pm1[i], 1), "pm25": round(pm25[i], 1), "pm10": round(pm10[i], 1),
+             "temp": round(28 + rng.normal(0, 0.5), 1), "hum": round(55 + rng.normal(0, 2), 1),
+             "lat": round(BASE[0] + rng.normal(0, 0.01), 6), "lon": round(BASE[1] + rng.normal(0, 0.01), 6)}
+        if devices > 1: d["device"] = f"esp32-{i % devices:03d}"
+        out.append(d)
+    return out
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('kind', choices=['flight', 'readings'])
+    ap.add_argument('size', type=int)
+    ap.add_argument('out')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--devices', type=int, default=1)
+    a = ap.parse_args()
+    if a.kind == 'flight':
+        with open(a.out, 'wb') as fh: fh.write(flight_bytes(a.size, 'xlsx' if a.out.endswith('.xlsx') else 'csv', a.seed))
+    else:
+        with open(a.out, 'w') as fh: fh.writelines(json.dumps(d) + '\n' for d in readings(a.size, a.devices, a.seed))
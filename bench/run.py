@@ -0,0 +1,165 @@
+"""SkySense hot-path benchmarks, compared against bench/baseline.json.
+
+    python bench/run.py                 # run, compare, exit 1 on a regression
+    python bench/run.py --update        # run and store the results as the new baseline
+    python bench/run.py --only upload   # just the benchmarks whose name contains 'upload'
+
+Each benchmark reports throughput (items/s), p50/p99 latency per operation and the peak
+Python heap (tracemalloc, numpy buffers included) of one extra operation.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+sys.path.insert(0, HERE)
+import generate  # noqa: E402
+
+def load_app(workdir):
+    # app.py keeps its database and uploads under the working directory; point both at a scratch dir.
+    # Uploads run inline so /upload timings include parsing; geocoding stays offline.
+    os.chdir(workdir)
+    os.environ.update(SKYSENSE_DB=os.path.join(workdir, 'bench.db'), SKYSENSE_UPLOAD_WORKERS='0', SKYSENSE_GEOCODER='offline')
+    sys.path.insert(0, os.path.dirname(HERE))
+    import app
+    return app
+
+def pct(sorted_times, p):
+    return sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * p / 100))]
+
+def measure(op, repeat, items=1, before=None, warmup=1):
+    """Times `op` repeat times (`before` runs untimed ahead of each call), then one traced call for peak memory"""
+    def call():
+        if before: before()
+        t = time.perf_counter()
+        op()
+        return time.perf_counter() - t
+    for _ in range(warmup): call()
+    times = sorted(call() for _ in range(repeat))
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"throughput": round(items * repeat / sum(times), 1), "p50_ms": round(pct(times, 50) * 1000, 3),
+            "p99_ms": round(pct(times, 99) * 1000, 3), "peak_kb": round(peak / 1024, 1)}
+
+def benchmarks(app, a):
+    """name -> (unit, thunk returning the measure() result)"""
+    c = app.app.test_client()
+    pairs = [(r['pm25'], r['pm10']) for r in generate.readings(10000, seed=1)]
+    flight = generate.flight_frame(a.rows, seed=1)
+    csv = generate.flight_bytes(a.rows, 'csv', seed=1)
+    xlsx = generate.flight_bytes(a.xlsx_rows, 'xlsx', seed=1)
+    # /upload dedups by content hash, so fresh-upload runs need a distinct file per call
+    files = a.runs * (a.repeat + 2)
+    fresh = iter([generate.flight_bytes(a.rows, 'csv', seed=100 + i) for i in range(files)])
+    fresh_xlsx = iter([generate.flight_bytes(a.xlsx_rows, 'xlsx', seed=10000 + i) for i in range(files)])
+    stream = iter(generate.readings(a.runs * (2 * a.readings + 10), seed=2))
+    fleet = iter(generate.readings(a.runs * (a.readings + 10), devices=a.devices, seed=3))
+
+    def upload(body, name):
+        r = c.post('/upload', data={'file': (io.BytesIO(body), name), 'date': '2026-01-01'})
+        assert r.status_code == 200, r.get_json()
+
+    def post(d):
+        r = c.post('/api/upload_sensor', json=d)
+        assert r.status_code == 200, r.get_json()
+
+    def get(url, status=200, **headers):
+        r = c.get(url, headers=headers)
+        assert r.status_code == status, r.status_code
+        r.get_data()
+
+    version = [0]
+    def refresh(): version[0] = c.get('/api/data?since=0').get_json()['version']
+    return {
+        "calculate_aqi": ("calls", lambda: measure(lambda: [app.calculate_aqi(p, q) for p, q in pairs], a.repeat, len(pairs))),
+        "calculate_aqi_array": ("rows", lambda: measure(lambda: app.calculate_aqi_array(flight['PM2.5 (ug/m3)'], flight['PM10 (ug/m3)']), a.repeat, a.rows)),
+        "normalize_columns": ("rows", lambda: measure(lambda: app.normalize_columns(flight), a.repeat, a.rows)),
+        "read_file_safely_csv": ("rows", lambda: measure(lambda: app.read_file_safely(io.BytesIO(csv)), a.repeat, a.rows)),
+        "read_file_safely_xlsx": ("rows", lambda: measure(lambda: app.read_file_safely(io.BytesIO(xlsx)), a.repeat, a.xlsx_rows)),
+        "upload_csv": ("rows", lambda: measure(lambda: upload(next(fresh), 'flight.csv'), a.repeat, a.rows)),
+        "upload_csv_duplicate": ("rows", lambda: measure(lambda: upload(csv, 'flight.csv'), a.repeat, a.rows)),
+        "upload_xlsx": ("rows", lambda: measure(lambda: upload(next(fresh_xlsx), 'flight.xlsx'), a.repeat, a.xlsx_rows)),
+        "upload_sensor": ("requests", lambda: measure(lambda: post(next(stream)), a.readings)),
+        "upload_sensor_fleet": ("requests", lambda: measure(lambda: post(next(fleet)), a.readings)),
+        "api_data": ("requests", lambda: measure(lambda: get('/api/data'), a.readings)),
+        "api_data_gzip": ("requests", lambda: measure(lambda: get('/api/data', **{'Accept-Encoding': 'gzip'}), a.readings)),
+        "api_data_after_write": ("requests", lambda: measure(lambda: get('/api/data'), a.readings // 2, before=lambda: post(next(stream)))),
+        "api_data_delta": ("requests", lambda: measure(lambda: get('/api/data?since=%d' % (version[0] - 1)), a.readings // 2, before=refresh)),
+        "api_data_304": ("requests", lambda: measure(lambda: get('/api/data?since=%d' % version[0], 304), a.readings // 2, before=refresh)),
+    }
+
+def compare(results, baseline, tolerance, slack_ms):
+    """Regressions against the baseline beyond tolerance (p99: twice that). Timings must also slip by more
+    than slack_ms, so sub-millisecond request benchmarks don't flag scheduler noise."""
+    out = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if not b: continue
+        slower = lambda new, old, tol: new > old * (1 + tol) and new - old > slack_ms
+        checks = [("p50_ms", slower(r['p50_ms'], b['p50_ms'], tolerance)), ("p99_ms", slower(r['p99_ms'], b['p99_ms'], 2 * tolerance)),
+                  ("throughput", r['throughput'] < b['throughput'] / (1 + tolerance) and slower(r['p50_ms'], b['p50_ms'], 0)),
+                  ("peak_kb", r['peak_kb'] > b['peak_kb'] * (1 + tolerance) + 64)]
+        out += [f"{name}: {k} {b[k]} -> {r[k]}" for k, bad in checks if bad]
+    return out
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--rows', type=int, default=20000, help="flight CSV rows")
+    ap.add_argument('--xlsx-rows', type=int, default=2000, help="flight XLSX rows")
+    ap.add_argument('--readings', type=int, default=300, help="requests per HTTP benchmark")
+    ap.add_argument('--devices', type=int, default=16, help="sensors in the fleet benchmark")
+    ap.add_argument('--repeat', type=int, default=5, help="operations per file/function benchmark")
+    ap.add_argument('--runs', type=int, default=3, help="runs per benchmark; the median of each metric is reported")
+    ap.add_argument('--only', default='', help="run benchmarks whose name contains this")
+    ap.add_argument('--tolerance', type=float, default=0.5, help="allowed relative slowdown before failing")
+    ap.add_argument('--slack-ms', type=float, default=0.5, help="timing changes smaller than this never count")
+    ap.add_argument('--baseline', default=BASELINE)
+    ap.add_argument('--update', action='store_true', help="write the results as the new baseline")
+    ap.add_argument('--json', help="also write the results to this file")
+    a = ap.parse_args()
+    params = {k: getattr(a, k) for k in ('rows', 'xlsx_rows', 'readings', 'devices', 'repeat', 'runs')}
+
+    with tempfile.TemporaryDirectory(prefix='skysense-bench-') as workdir:
+        app = load_app(workdir)
+        results = {}
+        print(f"{'benchmark':<24}{'throughput':>20}{'p50 ms':>11}{'p99 ms':>11}{'peak KiB':>11}")
+        for name, (unit, run) in benchmarks(app, a).items():
+            if a.only not in name: continue
+            runs = [run() for _ in range(a.runs)]
+            r = results[name] = {k: sorted(x[k] for x in runs)[len(runs) // 2] for k in runs[0]}
+            print(f"{name:<24}{r['throughput']:>12,.0f} {unit + '/s':<10}{r['p50_ms']:>8.3f}{r['p99_ms']:>11.3f}{r['peak_kb']:>11,.0f}")
+        os.chdir(HERE)
+
+    doc = {"params": params, "python": platform.python_version(), "machine": platform.machine(), "results": results}
+    if a.json:
+        with open(a.json, 'w') as fh: json.dump(doc, fh, indent=1)
+    if a.update:
+        if os.path.exists(a.baseline):
+            with open(a.baseline) as fh: old = json.load(fh)
+            if old.get('params') == params: doc['results'] = {**old['results'], **results}
+        with open(a.baseline, 'w') as fh: json.dump(doc, fh, indent=1, sort_keys=True)
+        print(f"baseline written to {a.baseline}")
+        return 0
+    if not os.path.exists(a.baseline):
+        print("no baseline; run with --update to create one")
+        return 0
+    with open(a.baseline) as fh: base = json.load(fh)
+    if base.get('params') != params:
+        print(f"baseline was recorded with {base.get('params')}; not comparing")
+        return 0
+    regressions = compare(results, base['results'], a.tolerance, a.slack_ms)
+    for line in regressions: print("REGRESSION", line)
+    if not regressions: print(f"no regressions against {os.path.relpath(a.baseline)} (tolerance {a.tolerance:.0%})")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# app.py keeps its database and uploads under the working directory: import it from a scratch dir,
+# with uploads parsed inline and no online geocoder
+WORKDIR = tempfile.mkdtemp(prefix='skysense-test-')
+os.chdir(WORKDIR)
+os.environ.update(SKYSENSE_DB=os.path.join(WORKDIR, 'test.db'), SKYSENSE_UPLOAD_WORKERS='0', SKYSENSE_GEOCODER='offline')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+import app
+
+def test_array_matches_scalar_on_band_edges():
+    # Every breakpoint, just either side of it, and the extremes
+    edges = [0, 30, 50, 60, 90, 100, 120, 250, 350, 430, 1000]
+    vals = sorted({v + d for v in edges for d in (-1e-9, 0, 1e-9, 0.5)})
+    pm25, pm10 = np.meshgrid(vals, vals)
+    got = app.calculate_aqi_array(pm25.ravel(), pm10.ravel())
+    assert got.tolist() == [app.calculate_aqi(a, b) for a, b in zip(pm25.ravel(), pm10.ravel())]
+
+def test_array_matches_scalar_on_random_values():
+    rng = np.random.default_rng(0)
+    pm25, pm10 = rng.uniform(-10, 900, 20000), rng.uniform(-10, 900, 20000)
+    got = app.calculate_aqi_array(pm25, pm10)
+    assert got.tolist() == [app.calculate_aqi(a, b) for a, b in zip(pm25, pm10)]
+
+def test_array_matches_scalar_on_bad_values():
+    odd = [math.nan, math.inf, -math.inf, None, '', 'abc', '42.5', 17, True]
+    pm25 = pd.Series([a for a in odd for _ in odd], dtype=object)
+    pm10 = pd.Series([b for _ in odd for b in odd], dtype=object)
+    got = app.calculate_aqi_array(pm25, pm10)
+    assert got.tolist() == [app.calculate_aqi(a, b) for a, b in zip(pm25, pm10)]
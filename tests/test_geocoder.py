@@ -0,0 +1,62 @@
+import queue
+
+import app
+
+class StubProvider:
+    """reverse() answers from a dict; a value that is an exception is raised instead"""
+    def __init__(self, answers): self.answers, self.calls = answers, []
+
+    def reverse(self, lat, lon):
+        self.calls.append((lat, lon))
+        name = self.answers.get((lat, lon))
+        if isinstance(name, Exception): raise name
+        return name
+
+def resolve(geocoder, lat, lon, timeout=5):
+    """Submits one lookup and waits for the background thread to finish it; returns the callback's name or None"""
+    done = queue.Queue()
+    geocoder.submit(lat, lon, lambda key, name: done.put(name))
+    try: return done.get(timeout=timeout)
+    except queue.Empty: return None
+
+def wait_idle(geocoder, timeout=5):
+    deadline = app.time.time() + timeout
+    while geocoder.pending and app.time.time() < deadline: app.time.sleep(0.01)
+    assert not geocoder.pending
+
+def test_name_is_cached():
+    stub = StubProvider({(10.001, 20.001): 'Somewhere, City'})
+    g = app.GeocodeQueue(stub, min_interval=0)
+    assert resolve(g, 10.001, 20.001) == 'Somewhere, City'
+    assert g.lookup(10.001, 20.001) == 'Somewhere, City'
+    wait_idle(g)
+    assert len(stub.calls) == 1
+
+def test_no_result_is_cached_as_empty():
+    stub = StubProvider({})
+    g = app.GeocodeQueue(stub, min_interval=0)
+    assert resolve(g, 11.001, 21.001) == '11.001, 21.001'  # callers get plain coordinates
+    wait_idle(g)
+    assert g.lookup(11.001, 21.001) == ''
+    resolve(g, 11.001, 21.001)
+    wait_idle(g)
+    assert len(stub.calls) == 1
+
+def test_provider_error_is_retried():
+    stub = StubProvider({(12.001, 22.001): RuntimeError('down')})
+    g = app.GeocodeQueue(stub, min_interval=0)
+    assert resolve(g, 12.001, 22.001, timeout=0.5) is None
+    wait_idle(g)
+    assert g.lookup(12.001, 22.001) is None
+    stub.answers[(12.001, 22.001)] = 'Later, City'
+    assert resolve(g, 12.001, 22.001) == 'Later, City'
+
+def test_store_error_still_clears_pending(monkeypatch):
+    stub = StubProvider({(13.001, 23.001): 'Fine, City'})
+    g = app.GeocodeQueue(stub, min_interval=0)
+    def broken(key): raise RuntimeError('database is locked')
+    monkeypatch.setattr(app.store, 'geocode_claim', broken)
+    assert resolve(g, 13.001, 23.001, timeout=0.5) is None
+    wait_idle(g)
+    monkeypatch.undo()
+    assert resolve(g, 13.001, 23.001) == 'Fine, City'  # the worker thread survived
@@ -0,0 +1,46 @@
+import json
+import random
+
+import app
+
+BUCKET = 300
+
+def brute_means(history, head, buckets):
+    vals = [v for ts, v in history if head - buckets < int(ts // BUCKET) <= head]
+    return round(sum(vals) / len(vals), 1) if vals else None
+
+def test_rolling_means_match_brute_force():
+    # Out-of-order readings, gaps longer than the ring (reset) and encode/load round trips
+    rng = random.Random(1)
+    for _ in range(100):
+        roll, history, now = app.RollingMeans(bucket_s=BUCKET), [], 1_700_000_000.0
+        for _ in range(60):
+            now += rng.choice([30 * 3600, 2 * 3600]) if rng.random() < 0.1 else rng.uniform(0, 900)
+            ts = now - (rng.uniform(0, 3 * 86400) if rng.random() < 0.25 else 0)
+            pm25 = rng.uniform(0, 100)
+            roll.add(ts, {'pm25': pm25})
+            history.append((ts, pm25))
+            if rng.random() < 0.2:
+                loaded = app.RollingMeans(bucket_s=BUCKET)
+                loaded.load(json.loads(roll.encode()))
+                roll = loaded
+            means = roll.means()
+            for name, buckets in roll.windows:
+                want, got = brute_means(history, roll.head, buckets), means[name]['pm25']
+                assert (want is None) == (got is None)
+                if want is not None: assert abs(want - got) <= 0.11  # both rounded to 0.1
+
+def test_late_reading_after_reset_is_kept():
+    roll = app.RollingMeans(bucket_s=BUCKET)
+    roll.add(1_700_000_000, {'pm25': 10})
+    roll.add(1_700_000_000 + 2 * 86400, {'pm25': 30})  # gap longer than the ring
+    roll.add(1_700_000_000 + 2 * 86400 - 1800, {'pm25': 50})
+    assert roll.means()['1h']['pm25'] == 40.0
+
+def test_reading_time_clamps_and_rejects():
+    assert app.reading_time({'ts': 1_700_000_000}) == 1_700_000_000
+    assert app.reading_time({'ts': 4e9}) <= app.time.time()
+    for bad in ('abc', -1, float('nan')):
+        try: app.reading_time({'ts': bad})
+        except ValueError: continue
+        raise AssertionError(bad)